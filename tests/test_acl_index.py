@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Checks AclIndex lookups against a brute-force longest-prefix search over the same access list.
+
+import random
+import pytest
+from w3act.dbc.acl_index import AclIndex
+from w3act.dbc.generate.acls import generate_acl
+
+DOMAINS = ['example.co.uk', 'example.com', 'bbc.co.uk', 'gov.uk', 'blog.org.uk', 'ex.ac.uk', 'shop.scot']
+PATHS = ['', 'news/', 'news/2020/', 'news/2020/story.html', 'a/b/c', 'about', 'about-us/']
+
+
+def random_targets(rng, count):
+    targets = []
+    for tid in range(1, count + 1):
+        urls = []
+        for i in range(rng.randint(1, 3)):
+            host = rng.choice(DOMAINS)
+            for j in range(rng.randint(0, 2)):
+                host = rng.choice(['www', 'sub', 'a', 'news', 'x1']) + '.' + host
+            urls.append('%s://%s/%s' % (rng.choice(['http', 'https']), host, rng.choice(PATHS)))
+        targets.append({'id': tid, 'urls': urls, 'scope': rng.choice(['root', 'subdomains', 'resource'])})
+    return targets
+
+
+def lookup_urls(rng, targets):
+    urls = ['http://cdnjs.cloudflare.com/lib.js', 'http://nowhere.example/', 'http://a/', 'https://uk/']
+    for t in targets:
+        for url in t['urls']:
+            urls += [url, url.rstrip('/') + '/deeper/page.html', url.replace('://', '://www.', 1),
+                     url.replace('://', '://other.', 1), url.replace('.uk/', '.ukk/')]
+    return rng.sample(urls, min(len(urls), 2000))
+
+
+def brute_force_match(acl, lines, url):
+    # The first line with the longest key that is a prefix of the URL's key:
+    key = acl.url_key(url)
+    best_key, best = None, None
+    for line in lines:
+        line_key = acl.line_key(line.encode('utf-8'))
+        if key.startswith(line_key) and (best_key is None or len(line_key) > len(best_key)):
+            best_key, best = line_key, line
+    return best
+
+
+@pytest.mark.parametrize('fmt', ['pywb', 'surts'])
+@pytest.mark.parametrize('compact', [False, True])
+def test_match_matches_brute_force(tmp_path, fmt, compact):
+    rng = random.Random(25)
+    targets = random_targets(rng, 300)
+    lines = generate_acl(targets, True, fmt, compact=compact)
+    acl_file = tmp_path / ('acl.%s' % fmt)
+    acl_file.write_text(''.join('%s\n' % line for line in lines), encoding='utf-8')
+    urls = lookup_urls(rng, targets)
+    with AclIndex(str(acl_file)) as acl:
+        assert acl.fmt == fmt
+        matched = 0
+        for url in urls:
+            expected = brute_force_match(acl, lines, url)
+            assert acl.match(url) == expected, url
+            matched += expected is not None
+        # Make sure the check covers both hits and misses:
+        assert 0 < matched < len(urls)
+
+
+def test_empty_list(tmp_path):
+    acl_file = tmp_path / 'empty.aclj'
+    acl_file.write_text('')
+    with AclIndex(str(acl_file)) as acl:
+        assert acl.match('http://www.example.co.uk/') is None
+        assert acl.access(None) == 'none'
+
+
+def test_access(tmp_path):
+    lines = generate_acl([{'id': 1, 'urls': ['http://www.example.co.uk/news/'], 'scope': 'root'}], False, 'pywb')
+    acl_file = tmp_path / 'one.aclj'
+    acl_file.write_text(''.join('%s\n' % line for line in lines), encoding='utf-8')
+    with AclIndex(str(acl_file)) as acl:
+        assert acl.access(acl.match('http://www.example.co.uk/news/today.html')) == 'allow'
+        assert acl.match('http://www.example.co.uk/sport/') is None
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# Checks the target, crawl schedule and taxonomy indexes against working them out the slow way.
+
+import random
+import datetime
+from dateutil.relativedelta import relativedelta
+from w3act.dbc.index import TargetIndex, ScheduleIndex, TaxonomyClosure, FIXED_PERIODS, MONTH_PERIODS, next_launch
+from w3act.dbc.model import as_datetime
+from w3act.dbc.client import filtered_targets
+
+FREQUENCIES = ['daily', 'Weekly', 'MONTHLY', 'quarterly', 'sixmonthly', 'annual', 'nevercrawl', 'domaincrawl', '']
+
+
+def test_target_index_matches_scan():
+    rng = random.Random(11)
+    now = datetime.datetime.now()
+    targets = {}
+    for tid in rng.sample(range(1, 10000), 500):
+        end = rng.choice(['', now - datetime.timedelta(days=rng.randint(1, 999)), now + datetime.timedelta(days=rng.randint(1, 999))])
+        targets[tid] = {
+            'id': tid,
+            'title': 'Target %i' % tid,
+            'crawl_frequency': rng.choice(FREQUENCIES + ['NEVERCRAWL', 'Daily']),
+            'isNPLD': rng.random() < 0.6,
+            'isOA': rng.random() < 0.3,
+            'hidden': rng.random() < 0.2,
+            'is_top_level_domain': rng.random() < 0.3,
+            # Timestamps are sometimes left as text when loaded:
+            'crawl_end_date': end.isoformat(sep=' ') if end and rng.random() < 0.2 else end,
+        }
+    index = TargetIndex(targets)
+    for frequency in [None, 'all', 'daily', 'WEEKLY', 'nevercrawl', 'unknown']:
+        for terms in ['npld', 'oa', 'bypm', 'all', None, 'unknown']:
+            for include_hidden in [True, False]:
+                for omit_uk_tlds in [True, False]:
+                    for include_expired in [True, False]:
+                        options = dict(frequency=frequency, terms=terms, include_hidden=include_hidden,
+                                       omit_uk_tlds=omit_uk_tlds, include_expired=include_expired)
+                        assert filtered_targets(targets, index=index, **options) == filtered_targets(targets, **options), options
+
+
+def random_time(rng, first_year, last_year):
+    start = datetime.datetime(first_year, 1, 1)
+    seconds = (datetime.datetime(last_year + 1, 1, 1) - start).total_seconds()
+    return start + datetime.timedelta(seconds=int(rng.random() * seconds))
+
+
+def random_targets(rng, count):
+    targets = {}
+    for tid in range(1, count + 1):
+        start = random_time(rng, 2015, 2025)
+        # Plenty of crawls starting at the end of the month:
+        if rng.random() < 0.3:
+            start = start.replace(day=28) + relativedelta(day=rng.choice([29, 30, 31]))
+        end = ''
+        if rng.random() < 0.4:
+            end = start + datetime.timedelta(days=rng.randint(0, 3000), seconds=rng.randint(0, 86399))
+        # Timestamps are sometimes left as text when loaded:
+        if rng.random() < 0.2:
+            start = start.isoformat(sep=' ')
+        targets[tid] = {
+            'id': tid,
+            'crawl_frequency': rng.choice(FREQUENCIES),
+            'crawl_start_date': start if rng.random() < 0.95 else '',
+            'crawl_end_date': end,
+        }
+    return targets
+
+
+def launches(start, frequency, until, after):
+    # Every launch of the schedule before 'until', skipping most of those well before 'after':
+    frequency = frequency.lower()
+    if frequency in FIXED_PERIODS:
+        period = FIXED_PERIODS[frequency]
+        k = max(0, (after - start) // period - 1)
+        while start + k * period < until:
+            yield start + k * period
+            k += 1
+    else:
+        months = MONTH_PERIODS[frequency]
+        k = max(0, ((after.year - start.year) * 12 + after.month - start.month) // months - 2)
+        while start + relativedelta(months=k * months) < until:
+            yield start + relativedelta(months=k * months)
+            k += 1
+
+
+def brute_force_due(targets, start, end):
+    due = []
+    for t in targets.values():
+        frequency = t['crawl_frequency'].lower()
+        if not t['crawl_start_date'] or (frequency not in FIXED_PERIODS and frequency not in MONTH_PERIODS):
+            continue
+        crawl_end = as_datetime(t['crawl_end_date']) if t['crawl_end_date'] else None
+        for launch in launches(as_datetime(t['crawl_start_date']), frequency, end, start):
+            if launch >= start and (crawl_end is None or launch <= crawl_end):
+                due.append(t)
+                break
+    return due
+
+
+def test_due_matches_brute_force():
+    rng = random.Random(13)
+    targets = random_targets(rng, 400)
+    index = ScheduleIndex(targets)
+    lengths = [datetime.timedelta(minutes=30), datetime.timedelta(hours=6), datetime.timedelta(days=1),
+               datetime.timedelta(days=3), datetime.timedelta(days=7), datetime.timedelta(days=40),
+               datetime.timedelta(days=100), datetime.timedelta(days=400)]
+    for i in range(300):
+        start = random_time(rng, 2014, 2027)
+        end = start + rng.choice(lengths)
+        assert index.due(start, end) == brute_force_due(targets, start, end), (start, end)
+
+
+def test_next_launch_clamps_to_month_end():
+    jan31 = datetime.datetime(2020, 1, 31, 12)
+    assert next_launch(jan31, 'monthly', datetime.datetime(2020, 2, 1)) == datetime.datetime(2020, 2, 29, 12)
+    # Later months go back to the 31st rather than staying on the 29th:
+    assert next_launch(jan31, 'monthly', datetime.datetime(2020, 3, 1)) == datetime.datetime(2020, 3, 31, 12)
+    assert next_launch(jan31, 'monthly', datetime.datetime(2020, 4, 1)) == datetime.datetime(2020, 4, 30, 12)
+    assert next_launch(jan31, 'Monthly', datetime.datetime(2021, 2, 1)) == datetime.datetime(2021, 2, 28, 12)
+    nov30 = datetime.datetime(2019, 11, 30)
+    assert next_launch(nov30, 'quarterly', datetime.datetime(2020, 1, 1)) == datetime.datetime(2020, 2, 29)
+    assert next_launch(nov30, 'quarterly', datetime.datetime(2020, 3, 1)) == datetime.datetime(2020, 5, 30)
+    leap_day = datetime.datetime(2020, 2, 29)
+    assert next_launch(leap_day, 'annual', datetime.datetime(2020, 3, 1)) == datetime.datetime(2021, 2, 28)
+    assert next_launch(leap_day, 'annual', datetime.datetime(2024, 1, 1)) == datetime.datetime(2024, 2, 29)
+
+
+def test_next_launch_before_start():
+    start = datetime.datetime(2020, 5, 5, 5, 5)
+    for frequency in ['daily', 'weekly', 'monthly', 'annual']:
+        assert next_launch(start, frequency, datetime.datetime(2019, 1, 1)) == start
+        assert next_launch(start, frequency, start) == start
+
+
+def test_due_across_the_end_of_the_period():
+    # Daily crawls either side of midnight, and a weekly one late on a Sunday, i.e. at the end of the period:
+    targets = {
+        1: {'id': 1, 'crawl_frequency': 'daily', 'crawl_start_date': datetime.datetime(2020, 1, 1, 23, 30), 'crawl_end_date': ''},
+        2: {'id': 2, 'crawl_frequency': 'weekly', 'crawl_start_date': datetime.datetime(2020, 1, 5, 23, 0), 'crawl_end_date': ''},
+        3: {'id': 3, 'crawl_frequency': 'daily', 'crawl_start_date': datetime.datetime(2020, 1, 1, 0, 30), 'crawl_end_date': ''},
+    }
+    index = ScheduleIndex(targets)
+    ids = lambda start, end: [t['id'] for t in index.due(start, end)]
+    # Ranges spanning midnight on a Sunday night, when both phases wrap around:
+    assert ids(datetime.datetime(2021, 3, 7, 22), datetime.datetime(2021, 3, 8, 2)) == [1, 2, 3]
+    assert ids(datetime.datetime(2021, 3, 7, 23, 45), datetime.datetime(2021, 3, 8, 2)) == [3]
+    assert ids(datetime.datetime(2021, 3, 7, 23, 45), datetime.datetime(2021, 3, 8, 0, 30)) == []
+    assert ids(datetime.datetime(2021, 3, 6, 22), datetime.datetime(2021, 3, 7, 2)) == [1, 3]
+    assert ids(datetime.datetime(2021, 3, 8, 1), datetime.datetime(2021, 3, 8, 23)) == []
+    assert ids(datetime.datetime(2021, 3, 8, 0), datetime.datetime(2021, 3, 8, 23, 31)) == [1, 3]
+
+
+def random_taxonomy(rng, count):
+    # A forest of terms, as extract_taxonomy builds them, with targets scattered over the terms:
+    roots = []
+    terms = []
+    for tid in range(1, count + 1):
+        term = {'id': tid, 'children': [], 'target_ids': rng.sample(range(1, 60), rng.randint(0, 4))}
+        if terms and rng.random() < 0.8:
+            rng.choice(terms)['children'].append(term)
+        else:
+            roots.append(term)
+        terms.append(term)
+    return roots
+
+
+def brute_force_closure(roots):
+    # Parent, depth, descendants and the targets below every term, by recursion:
+    parent, depth, descendants, target_ids = {}, {}, {}, {}
+
+    def visit(term, pid, d):
+        parent[term['id']], depth[term['id']] = pid, d
+        below = []
+        targets = set(term['target_ids'])
+        for child in term['children']:
+            below.append(child['id'])
+            below.extend(visit(child, term['id'], d + 1))
+            targets |= target_ids[child['id']]
+        descendants[term['id']] = below
+        target_ids[term['id']] = targets
+        return below
+
+    for root in roots:
+        visit(root, None, 0)
+    return parent, depth, descendants, target_ids
+
+
+def test_taxonomy_closure_matches_brute_force():
+    rng = random.Random(17)
+    roots = random_taxonomy(rng, 300)
+    closure = TaxonomyClosure(roots)
+    parent, depth, descendants, target_ids = brute_force_closure(roots)
+    assert sorted(closure.terms) == sorted(parent)
+    for tid in closure.terms:
+        assert closure.parent[tid] == parent[tid]
+        assert closure.depth[tid] == depth[tid]
+        assert closure.descendants(tid) == descendants[tid]
+        assert closure.subtree_target_ids[tid] == target_ids[tid]
+        assert closure.target_count(tid) == len(target_ids[tid])
+        assert [term['id'] for term in closure.path(tid)] == closure.ancestors(tid) + [tid]
+        assert len(closure.ancestors(tid)) == depth[tid]
+        for other in rng.sample(list(closure.terms), 20):
+            assert closure.is_ancestor(tid, other) == (other in descendants[tid])
+
+
+def test_taxonomy_closure_of_a_deep_chain():
+    # Much deeper than the recursion limit:
+    top = term = {'id': 0, 'children': [], 'target_ids': []}
+    for tid in range(1, 20000):
+        child = {'id': tid, 'children': [], 'target_ids': []}
+        term['children'].append(child)
+        term = child
+    term['target_ids'] = [42]
+    closure = TaxonomyClosure([top])
+    assert closure.depth[19999] == 19999
+    assert len(closure.descendants(0)) == 19999
+    assert closure.target_count(0) == 1
+    assert closure.is_ancestor(0, 19999) and not closure.is_ancestor(19999, 0)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# Offline lookups of URLs in the access lists written by generate_acl, without loading them.
+#
+# The file is memory-mapped and binary-searched in place, so even large lists can be opened and
+# queried straight away. Both of the SURT-keyed formats are supported: pywb aclj files, which
+# are sorted in reverse order, and plain lists of SURT prefixes, which are sorted in order.
+
+import os
+import mmap
+import json
+import logging
+from w3act.dbc.generate.acls import url_surt
+
+logger = logging.getLogger(__name__)
+
+
+class AclIndex(object):
+    """
+    Longest-prefix matching of URLs against a generated access list file, as pywb does, i.e.
+    finding the rule with the longest key that is a prefix of the URL's SURT.
+
+    Each lookup is a few binary searches over the lines of the file: the nearest key at or
+    before the URL's SURT is either a prefix of it, and so the match, or shares a common
+    prefix with it, and any match must be a prefix of that in turn.
+    """
+
+    def __init__(self, acl_file):
+        self.acl_file = acl_file
+        self.f = open(acl_file, 'rb')
+        if os.fstat(self.f.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+        # pywb rules are 'key - {json}', whereas SURT lists are just the SURT prefixes:
+        first_line = self.data[:self.data.find(b'\n')] if b'\n' in self.data[:4096] else self.data[:4096]
+        self.fmt = 'pywb' if b' - {' in first_line else 'surts'
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def line_key(self, line):
+        if self.fmt == 'pywb':
+            return line.split(b' ', 1)[0]
+        return line
+
+    def url_key(self, url):
+        # The key to look up for the URL, in the same form as the keys in the file:
+        key = url_surt(url)
+        if self.fmt == 'pywb':
+            key = key.replace('http://(', '', 1)
+        return key.encode('utf-8')
+
+    def _line(self, start):
+        end = self.data.find(b'\n', start)
+        if end == -1:
+            end = len(self.data)
+        return self.data[start:end], end
+
+    def _bisect(self, before):
+        # The offset of the first line for which before(line) is false, given that it is true
+        # for all the lines up to some point in the file, and false for the rest:
+        lo, hi = 0, len(self.data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.data.rfind(b'\n', 0, mid) + 1
+            line, end = self._line(start)
+            if before(line):
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def _floor(self, key):
+        # The first line in the file whose key is the greatest one at or before the given key:
+        if self.fmt == 'pywb':
+            # Reverse order, so it's the first line with a key that is not after the given one:
+            start = self._bisect(lambda line: self.line_key(line) > key)
+        else:
+            # The lines with the greatest key at or before the given one run up to this point:
+            end = self._bisect(lambda line: line <= key)
+            if end == 0:
+                return None
+            floor_key = self._line(self.data.rfind(b'\n', 0, end - 1) + 1)[0]
+            start = self._bisect(lambda line: line < floor_key)
+        if start >= len(self.data):
+            return None
+        line = self._line(start)[0]
+        return line if line else None
+
+    def match(self, url):
+        # The matching line of the file, as a string, or None if no rule matches:
+        key = self.url_key(url)
+        while key:
+            line = self._floor(key)
+            if line is None:
+                return None
+            floor_key = self.line_key(line)
+            if key.startswith(floor_key):
+                return line.decode('utf-8')
+            # Any match must be a prefix of the part both keys share:
+            common = 0
+            while common < len(key) and common < len(floor_key) and key[common] == floor_key[common]:
+                common += 1
+            key = key[:common]
+        return None
+
+    def access(self, rule):
+        # The access level of a matching line, e.g. 'allow' for pywb rules, or 'in' for SURT prefixes:
+        if rule is None:
+            return 'none'
+        if self.fmt == 'pywb':
+            return json.loads(rule.split(' - ', 1)[1]).get('access', 'none')
+        return 'in'
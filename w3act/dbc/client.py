@@ -1,42 +1,339 @@
-import dateutil.parser
 import datetime
 import argparse
 import psycopg2
 import logging
-from urllib.parse import urlparse
-import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import hashlib
+import zipfile
+import pickle
+import gzip
 import json
 import csv
+import io
 import os
 import re
+from w3act.dbc.schema import SCHEMA, TARGET_FLAGS, project_columns
+from w3act.dbc.model import Target, DATE_FIELDS, TAXONOMY_DATE_FIELDS, db_datetime, as_datetime, format_db_datetime, to_json
+from w3act.dbc.surts import SurtTrie, surt_tokens
+from w3act.dbc.generate.acls import generate_surts
 
 # Set logging for this module and keep the reference handy:
 logger = logging.getLogger( __name__ )
 
-def get_csv(csv_dir, params):
+MANIFEST_FILE = 'manifest.json'
+
+# Binary snapshot of the loaded model, stored alongside the CSV files it was built from.
+# Bump the version whenever the structure built by load_rows changes:
+MODEL_CACHE_FILE = '.w3act-model.pickle'
+MODEL_CACHE_VERSION = 3
+
+# File extensions used for the supported CSV compression schemes:
+CSV_EXTENSIONS = {
+    None: '.csv',
+    'gzip': '.csv.gz',
+    'zstd': '.csv.zst',
+}
+
+# The tables that load_rows reads, in the order they are loaded:
+LOAD_TABLES = [
+    'target', 'field_url', 'taxonomy', 'collection_target', 'subject_target',
+    'taxonomy_parents_all', 'watched_target', 'license_target', 'creator', 'organisation'
+]
+
+# The optional entities that can be loaded, and the tables each one needs. Targets and the
+# taxonomy they refer to are always loaded:
+ENTITY_TABLES = {
+    'urls': ['field_url'],
+    'collections': ['collection_target'],
+    'subjects': ['subject_target'],
+    'collection_areas': ['taxonomy_parents_all'],
+    'watched': ['watched_target'],
+    'licenses': ['license_target'],
+    'curators': ['creator'],
+    'organisations': ['organisation'],
+}
+
+
+def list_tables(cur):
+    cur.execute("""SELECT table_name FROM information_schema.tables
+           WHERE table_schema = 'public'""")
+    return [row[0] for row in cur.fetchall()]
+
+
+def list_columns(cur):
+    cur.execute("""SELECT table_name, column_name FROM information_schema.columns
+           WHERE table_schema = 'public' ORDER BY table_name, ordinal_position""")
+    columns = {}
+    for table, column in cur.fetchall():
+        columns.setdefault(table, []).append(column)
+    return columns
+
+
+def read_manifest(csv_dir):
+    manifest_file = os.path.join(csv_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f).get('tables', {})
+
+
+def write_manifest(csv_dir, tables):
+    manifest_file = os.path.join(csv_dir, MANIFEST_FILE)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump({
+            'generated_at': datetime.datetime.now().isoformat(),
+            'tables': tables
+        }, f, indent=2, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def csv_compression(csv_file):
+    for compression, ext in CSV_EXTENSIONS.items():
+        if compression and csv_file.endswith(ext):
+            return compression
+    return None
+
+
+def find_csv_file(csv_dir, table):
+    # Use whichever (possibly compressed) copy of the table is present:
+    for ext in CSV_EXTENSIONS.values():
+        csv_file = os.path.join(csv_dir, table + ext)
+        if os.path.exists(csv_file):
+            return csv_file
+    return os.path.join(csv_dir, table + CSV_EXTENSIONS[None])
+
+
+def open_csv(csv_file, mode='rt', compression=None, newline=None):
+    # Opens plain, gzip or zstd CSV files, (de)compressing as a stream.
+    # Already-open binary files can be passed too, along with their compression:
+    if not compression and isinstance(csv_file, str):
+        compression = csv_compression(csv_file)
+    kwargs = {}
+    if 't' in mode:
+        kwargs = {'encoding': 'utf-8', 'newline': newline}
+    if compression is None:
+        if not isinstance(csv_file, str):
+            return io.TextIOWrapper(csv_file, **kwargs) if 't' in mode else csv_file
+        return open(csv_file, mode, **kwargs)
+    elif compression == 'gzip':
+        return gzip.open(csv_file, mode, **kwargs)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("The 'zstandard' package is required for zstd-compressed CSV files!")
+        return zstandard.open(csv_file, mode, **kwargs)
+    else:
+        raise Exception("Unknown CSV compression '%s'!" % compression)
+
+
+def select_list(columns):
+    return ', '.join('"%s"' % column.replace('"', '""') for column in columns)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class HashingWriter(io.RawIOBase):
+    """
+    Passes writes through to a binary file, checksumming the bytes on the way, so files
+    do not need to be read back afterwards to checksum them.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def merge_table_changes(cur, table, csv_file, columns, since):
+    id_col = columns.index('id')
+
+    # Which rows still exist? Anything else in the cached copy has been deleted:
+    cur.execute("SELECT id::text FROM %s" % table)
+    live_ids = set(row[0] for row in cur.fetchall())
+
+    # Rows changed since the last high-water mark (inclusive, as timestamps are not unique):
+    changes = io.StringIO()
+    sql = "COPY (SELECT %s FROM %s WHERE updated_at >= %%s OR updated_at IS NULL) TO STDOUT WITH CSV" % (select_list(columns), table)
+    cur.copy_expert(cur.mogrify(sql, (since,)).decode('utf-8'), changes)
+    changes.seek(0)
+    changed = {}
+    for row in csv.reader(changes):
+        changed[row[id_col]] = row
+    num_changed = len(changed)
+
+    # Merge into the cached copy, keeping the existing row order and appending new rows,
+    # and counting and checksumming what is written:
+    deleted = 0
+    rows = 0
+    with open_csv(csv_file, 'rt', newline='') as f_in, open(csv_file + '.tmp', 'wb') as f_raw:
+        hashed = HashingWriter(f_raw)
+        with open_csv(hashed, 'wt', csv_compression(csv_file), newline='') as f_out:
+            reader = csv.reader(f_in)
+            writer = csv.writer(f_out, lineterminator='\n')
+            writer.writerow(next(reader))
+            for row in reader:
+                rid = row[id_col]
+                if rid not in live_ids:
+                    deleted += 1
+                    continue
+                writer.writerow(changed.pop(rid, row))
+                rows += 1
+            for row in changed.values():
+                writer.writerow(row)
+                rows += 1
+    os.replace(csv_file + '.tmp', csv_file)
+
+    return {'changed': num_changed, 'deleted': deleted, 'rows': rows, 'sha256': hashed.hexdigest()}
+
+
+def download_table(cur, table, csv_dir, columns=[], previous=None, compression=None, project=False):
+    csv_file = os.path.join(csv_dir, table + CSV_EXTENSIONS[compression])
+    source = table
+    if project:
+        columns = project_columns(table, columns)
+        source = "(SELECT %s FROM %s)" % (select_list(columns), table)
+    entry = {'mode': 'full', 'columns': columns, 'file': os.path.basename(csv_file)}
+
+    # Tables with a primary key and a modification time can be updated incrementally:
+    incremental = 'id' in columns and 'updated_at' in columns
+    if incremental:
+        cur.execute("SELECT max(updated_at)::text FROM %s" % table)
+        entry['high_water_mark'] = cur.fetchone()[0]
+
+    # Only merge into a cached copy that is known to match the previous run:
+    if incremental and previous and previous.get('high_water_mark') \
+            and previous.get('columns') == columns \
+            and os.path.exists(csv_file) \
+            and file_sha256(csv_file) == previous.get('sha256'):
+        print("Downloading changes to table %s since %s" % (table, previous['high_water_mark']))
+        entry['mode'] = 'delta'
+        entry.update(merge_table_changes(cur, table, csv_file, columns, previous['high_water_mark']))
+    else:
+        print("Downloading table %s" % table)
+        with open(csv_file, 'wb') as f_raw:
+            hashed = HashingWriter(f_raw)
+            with open_csv(hashed, 'wb', compression) as f:
+                cur.copy_expert("COPY %s TO STDOUT WITH CSV HEADER" % source, f)
+        # COPY reports how many rows it sent:
+        entry['rows'], entry['sha256'] = cur.rowcount, hashed.hexdigest()
+
+    # Remove any copies of this table stored with a different compression:
+    for ext in CSV_EXTENSIONS.values():
+        other_file = os.path.join(csv_dir, table + ext)
+        if other_file != csv_file and os.path.exists(other_file):
+            os.remove(other_file)
+
+    return entry
+
+
+def get_csv(csv_dir, params, workers=1, delta=False, compression=None, project=False):
     conn = psycopg2.connect(**params)
+    # Read all tables from a single read-only snapshot, so they are consistent with each other:
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
     cur = conn.cursor()
 
     csv_dir = os.path.abspath(csv_dir)
     if not os.path.exists(csv_dir):
         os.mkdir(csv_dir)
 
-    cur.execute("""SELECT table_name FROM information_schema.tables
-           WHERE table_schema = 'public'""")
-    for table in cur.fetchall():
-        print("Downloading table %s" % table)
-        csv_file = os.path.join(csv_dir,'%s.csv' % table)
-        with open(csv_file, 'wb') as f:
-            cur.copy_expert("COPY %s TO STDOUT WITH CSV HEADER" % table, f)
+    tables = list_tables(cur)
+    columns = list_columns(cur)
+    previous = read_manifest(csv_dir) if delta else {}
+
+    # Skip the tables we don't use:
+    if project:
+        tables = [table for table in tables if table in SCHEMA]
+
+    def export(cur, table):
+        return download_table(cur, table, csv_dir, columns.get(table, []), previous.get(table), compression, project)
+
+    if workers > 1:
+        manifest = get_csv_parallel(conn, tables, export, params, workers)
+    else:
+        manifest = {}
+        for table in tables:
+            manifest[table] = export(cur, table)
 
     cur.close()
+    conn.rollback()
     conn.close()
 
+    write_manifest(csv_dir, manifest)
+
+
+def get_csv_parallel(conn, tables, export, params, workers):
+    # Export the snapshot of the (already REPEATABLE READ) coordinating transaction, so that every
+    # worker connection sees exactly the same database state and the CSV set stays consistent:
+    cur = conn.cursor()
+    cur.execute("SELECT pg_export_snapshot()")
+    snapshot_id = cur.fetchone()[0]
+    logger.info("Exported snapshot %s for %i workers" % (snapshot_id, workers))
+
+    # Start on the biggest tables first, so the total run time is close to that of the biggest one:
+    cur.execute("""SELECT c.relname, pg_total_relation_size(c.oid) FROM pg_class c
+           JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = 'public'""")
+    sizes = dict(cur.fetchall())
+    tables = sorted(tables, key=lambda table: sizes.get(table, 0), reverse=True)
+
+    # Each worker thread lazily opens its own connection, joined to the exported snapshot:
+    local = threading.local()
+    worker_conns = []
+    lock = threading.Lock()
+
+    def worker_cursor():
+        if not hasattr(local, 'cur'):
+            wconn = psycopg2.connect(**params)
+            with lock:
+                worker_conns.append(wconn)
+            wconn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            local.cur = wconn.cursor()
+            local.cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+        return local.cur
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            entries = executor.map(lambda table: export(worker_cursor(), table), tables)
+            # Consume the results so any failure is raised here:
+            return dict(zip(tables, entries))
+    finally:
+        # The snapshot is only valid while the exporting transaction is open, so end that last:
+        for wconn in worker_conns:
+            wconn.close()
+        cur.close()
+
 
 def csv_to_zip(csv_dir):
-    # Bundle as a ZIP:
-    parent_dir = os.path.abspath(os.path.join(csv_dir, os.pardir))
-    return shutil.make_archive(csv_dir, 'zip', parent_dir, os.path.basename(csv_dir))
+    # Bundle as a ZIP, just storing any files that are already compressed:
+    csv_dir = os.path.abspath(csv_dir)
+    zip_file = '%s.zip' % csv_dir
+    with zipfile.ZipFile(zip_file, 'w') as zf:
+        for name in sorted(os.listdir(csv_dir)):
+            path = os.path.join(csv_dir, name)
+            if not os.path.isfile(path) or name == MODEL_CACHE_FILE:
+                continue
+            if csv_compression(name):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            zf.write(path, os.path.join(os.path.basename(csv_dir), name), compress_type=compress_type)
+    return zip_file
 
 
 def check_npld_status(target):
@@ -61,13 +358,24 @@ def check_oa_status(target):
     return False
 
 
-def attach_child_terms(col, bypid):
-    children = col.get('children', [])
-    cid = col['id']
-    for child in bypid.get(cid, []):
-        attach_child_terms(child, bypid)
-        children.append(child)
-    col['children'] = children
+def attach_child_terms(col, bypid, attached=None):
+    # Works down the tree with a stack rather than by recursion, so deep trees are not a problem,
+    # and refuses to attach any term twice, so bad parent IDs can not make it loop forever:
+    if attached is None:
+        attached = set()
+    attached.add(col['id'])
+    stack = [col]
+    while stack:
+        term = stack.pop()
+        children = term.get('children', [])
+        for child in bypid.get(term['id'], []):
+            if child['id'] in attached:
+                logger.warning("Taxonomy term %s appears more than once in the tree under %s!" % (child['id'], col['id']))
+                continue
+            attached.add(child['id'])
+            children.append(child)
+            stack.append(child)
+        term['children'] = children
 
 
 def extract_taxonomy(tax, tax_name):
@@ -83,194 +391,419 @@ def extract_taxonomy(tax, tax_name):
                 children.append(tax[tid])
                 bypid[pid] = children
 
+    attached = set()
     for tid in topc:
         col = topc[tid]
-        attach_child_terms(col, bypid)
+        attach_child_terms(col, bypid, attached)
+
+    # Report any terms whose parents loop back around, as they can never be reached from the top:
+    checked = set(attached)
+    for pid in bypid:
+        seen = set()
+        while pid in tax and pid not in seen and pid not in checked and tax[pid]['parent_id']:
+            seen.add(pid)
+            pid = int(tax[pid]['parent_id'])
+        if pid in seen:
+            logger.warning("Taxonomy term %s is part of a cycle of parents, so has been left out of the %s tree!" % (pid, tax_name))
+        checked.update(seen)
 
     return topc
 
 
-def load_csv(csv_dir="./test/w3act-csv"):
-    logger.info("Loading W3ACT data...")
-    logger.info("Loading targets...")
+def csv_rows(csv_dir, project=False):
+    # Source of table rows, read from the CSV files:
+    def rows(table):
+        wanted = set(SCHEMA.get(table, []))
+        with open_csv(find_csv_file(csv_dir, table)) as csv_file:
+            for row in csv.DictReader(csv_file):
+                if project:
+                    row = {key: value for key, value in row.items() if key in wanted}
+                yield row
+    return rows
+
+
+def to_csv_text(value):
+    # Render a value the way COPY ... WITH CSV would, so rows match those read from CSV:
+    if value is None:
+        return ''
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, datetime.datetime):
+        text = format_db_datetime(value.replace(tzinfo=None))
+        offset = value.utcoffset()
+        if offset is not None:
+            minutes = int(offset.total_seconds() // 60)
+            sign = '-' if minutes < 0 else '+'
+            hours, minutes = divmod(abs(minutes), 60)
+            text += '%s%02d' % (sign, hours) + (':%02d' % minutes if minutes else '')
+        return text
+    elif isinstance(value, datetime.date):
+        return value.isoformat()
+    elif isinstance(value, str):
+        # Match the newline translation applied when reading the CSV files in text mode:
+        return value.replace('\r\n', '\n').replace('\r', '\n')
+    return str(value)
+
+
+def db_rows(conn, batch_size=10000, columns=None):
+    # Source of table rows, streamed in batches from the database via server-side cursors:
+    def rows(table):
+        with conn.cursor(name='w3act_%s' % table) as cur:
+            cur.itersize = batch_size
+            if columns is None:
+                cur.execute("SELECT * FROM %s" % table)
+            else:
+                cur.execute("SELECT %s FROM %s" % (select_list(columns[table]), table))
+            names = None
+            for record in cur:
+                if names is None:
+                    names = [col[0] for col in cur.description]
+                yield dict(zip(names, [to_csv_text(value) for value in record]))
+    return rows
+
+
+def csv_files_state(csv_dir):
+    # The size and modification time of each CSV file in the folder:
+    state = {}
+    for name in sorted(os.listdir(csv_dir)):
+        if name.endswith(tuple(CSV_EXTENSIONS.values())):
+            st = os.stat(os.path.join(csv_dir, name))
+            state[name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    return state
+
+
+def load_model_cache(csv_dir, options):
+    cache_file = os.path.join(csv_dir, MODEL_CACHE_FILE)
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            # The header is pickled separately, so it can be checked without loading the model:
+            header = pickle.load(f)
+            if header.get('version') != MODEL_CACHE_VERSION:
+                logger.info("Model cache %s is from a different version, rebuilding..." % cache_file)
+                return None
+            if header.get('options') != options:
+                logger.info("Model cache %s was built with different options, rebuilding..." % cache_file)
+                return None
+            state = csv_files_state(csv_dir)
+            if state.keys() != header['files'].keys():
+                logger.info("CSV files have been added or removed, rebuilding model cache...")
+                return None
+            for name, file_state in state.items():
+                cached = header['files'][name]
+                if file_state['size'] != cached['size']:
+                    logger.info("CSV file %s has changed, rebuilding model cache..." % name)
+                    return None
+                # Files that have been touched but have the same content are still fine:
+                if file_state['mtime_ns'] != cached['mtime_ns'] \
+                        and file_sha256(os.path.join(csv_dir, name)) != cached['sha256']:
+                    logger.info("CSV file %s has changed, rebuilding model cache..." % name)
+                    return None
+            logger.info("Loading W3ACT data from model cache %s..." % cache_file)
+            return pickle.load(f)
+    except Exception as e:
+        logger.warning("Could not read model cache %s, rebuilding: %s" % (cache_file, e))
+        return None
 
+
+def save_model_cache(csv_dir, all, options):
+    cache_file = os.path.join(csv_dir, MODEL_CACHE_FILE)
+    files = csv_files_state(csv_dir)
+    for name in files:
+        files[name]['sha256'] = file_sha256(os.path.join(csv_dir, name))
+    header = {
+        'version': MODEL_CACHE_VERSION,
+        'options': options,
+        'files': files
+    }
+    try:
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(all, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + '.tmp', cache_file)
+        logger.info("Saved model cache %s" % cache_file)
+    except OSError as e:
+        logger.warning("Could not write model cache %s: %s" % (cache_file, e))
+
+
+def load_csv(csv_dir="./test/w3act-csv", use_cache=False, project=False, compact=False, workers=1, entities=None):
     if not os.path.exists(csv_dir):
         raise ValueError("ERROR! CSV folder does not exist: %s" % csv_dir)
 
     if not os.listdir(csv_dir):
         raise ValueError("ERROR! CSV folder is empty: %s" % csv_dir)        
 
-    targets = {}
-    with open(os.path.join(csv_dir,'target.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['id'] != 'id': # Skip header row
-                # Turn booleans into proper booleans:
-                tfs = ["active", "hidden", "ignore_robots_txt", "is_in_scope_ip", "is_in_scope_ip_without_license",
-                       "is_top_level_domain", "is_uk_hosting", "is_uk_registration", "key_site", "no_ld_criteria_met",
-                       "professional_judgement", "special_dispensation", "uk_postal_address", "via_correspondence"]
-                for tf in tfs:
-                    if row[tf] == 't':
-                        row[tf] = True
-                    else:
-                        row[tf] = False
-                # turn id into int
-                row['id'] = int(row['id'])
-                # And store
-                targets[row['id']] = row
+    options = {'project': project, 'compact': compact}
+    if use_cache:
+        all = load_model_cache(csv_dir, options)
+        if all is not None:
+            return all
+        # The cache always holds the whole model, so it can be used by every action, and only
+        # loads without it leave out the entities the action doesn't need:
+        entities = None
+
+    if workers > 1:
+        logger.info("Loading W3ACT data using %i processes..." % workers)
+        all = join_tables(parse_csv_tables(csv_dir, project, compact, workers, entities), workers)
+    else:
+        all = load_rows(csv_rows(csv_dir, project), compact, entities)
 
-    # JOIN to get URLs:
-    logger.info("Loading URLs...")
-    with open(os.path.join(csv_dir,'field_url.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['id'] != 'id':
-                tid = int(row['target_id'])
-                if tid not in targets:
-                    logger.warning(f"So such Target {tid} - no match for URL row: {row}")
-                    continue
-                urls = targets[tid].get('urls', [])
-                if row['position'] != '':
-                    urls.insert(int(row['position']),row['url'])
+    if use_cache:
+        save_model_cache(csv_dir, all, options)
+
+    return all
+
+
+def load_db(params, batch_size=10000, project=False, compact=False, entities=None):
+    conn = psycopg2.connect(**params)
+    # Read all tables from a single read-only snapshot, so they are consistent with each other:
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        columns = None
+        if project:
+            with conn.cursor() as cur:
+                columns = {table: project_columns(table, cols) for table, cols in list_columns(cur).items()}
+        return load_rows(db_rows(conn, batch_size, columns), compact, entities)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def load_rows(rows, compact=False, entities=None):
+    logger.info("Loading W3ACT data...")
+    return join_tables({table: parse_table(rows, table, compact) for table in entity_tables(entities)})
+
+
+def entity_tables(entities=None):
+    # The tables needed to load the given entities (or everything, if None), in load order:
+    if entities is None:
+        return LOAD_TABLES
+    wanted = set(['target', 'taxonomy'])
+    for entity in entities:
+        if entity not in ENTITY_TABLES:
+            raise Exception("Unknown entity '%s'! Should be one of %s" % (entity, ", ".join(ENTITY_TABLES)))
+        wanted.update(ENTITY_TABLES[entity])
+    return [table for table in LOAD_TABLES if table in wanted]
+
+
+def parse_csv_table(csv_dir, table, project=False, compact=False):
+    # Parse a single CSV table (run in a worker process by parse_csv_tables):
+    return parse_table(csv_rows(csv_dir, project), table, compact)
+
+
+def parse_csv_tables(csv_dir, project=False, compact=False, workers=1, entities=None):
+    # Parse the tables in parallel over a pool of processes, biggest first:
+    load_tables = entity_tables(entities)
+    sizes = {table: os.path.getsize(find_csv_file(csv_dir, table)) for table in load_tables}
+    tables = sorted(load_tables, key=lambda table: sizes[table], reverse=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {table: executor.submit(parse_csv_table, csv_dir, table, project, compact) for table in tables}
+        return {table: futures[table].result() for table in load_tables}
+
+
+def parse_table(rows, table, compact=False):
+    # Each table is parsed on its own, and only combined with the others by join_tables:
+    if table == 'target':
+        return parse_targets(rows, compact)
+    elif table == 'field_url':
+        return parse_urls(rows)
+    elif table == 'taxonomy':
+        return parse_taxonomy(rows)
+    elif table == 'collection_target':
+        return parse_links(rows, table, 'target_id', 'collection_id')
+    elif table == 'subject_target':
+        return parse_links(rows, table, 'target_id', 'subject_id')
+    elif table == 'taxonomy_parents_all':
+        return parse_links(rows, table, 'taxonomy_id', 'parent_id')
+    elif table == 'license_target':
+        return parse_links(rows, table, 'target_id', 'license_id')
+    elif table == 'watched_target':
+        return parse_watched(rows)
+    elif table == 'creator':
+        # Pop some unnecessary fields:
+        return parse_records(rows, table, ['password', 'url', 'edit_url', 'affiliation'])
+    elif table == 'organisation':
+        # Pop some unnecessary fields:
+        return parse_records(rows, table, ['author_id', 'url', 'edit_url', 'affiliation'])
+    else:
+        raise Exception("Don't know how to load table '%s'!" % table)
+
+
+def parse_targets(rows, compact=False):
+    logger.info("Loading targets...")
+    targets = {}
+    for row in rows('target'):
+        if row['id'] != 'id': # Skip header row
+            # Turn booleans into proper booleans:
+            for tf in TARGET_FLAGS:
+                if row[tf] == 't':
+                    row[tf] = True
                 else:
-                    urls.append(row['url'])
-                targets[tid]['urls'] = urls
+                    row[tf] = False
+            # turn id into int
+            row['id'] = int(row['id'])
+            # Parse the timestamps once, here:
+            for f in DATE_FIELDS:
+                if f in row:
+                    row[f] = db_datetime(row[f])
+            # And store, optionally as a more compact record:
+            if compact:
+                row = Target(row)
+            targets[row['id']] = row
+    return targets
+
+
+def parse_urls(rows):
+    logger.info("Loading URLs...")
+    urls = []
+    for row in rows('field_url'):
+        if row['id'] != 'id':
+            position = int(row['position']) if row['position'] != '' else None
+            urls.append((int(row['target_id']), position, row['url']))
+    return urls
+
 
-    # Grab the taxonomies
+def parse_taxonomy(rows):
     logger.info("Loading taxonomies...")
     tax = {}
-    with open(os.path.join(csv_dir,'taxonomy.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['id'] != 'id':
-                # Turn booleans into proper booleans:
-                tfs = ["publish"] # ie. ["publish", optional_boolean2, ..., optional_booleanN]
-                for tf in tfs:
-                    if row[tf] == 't':
-                        row[tf] = True
-                    else:
-                        row[tf] = False
-                # turn id into int
-                row['id'] = int(row['id'])
-                tax[row['id']] = row
-
-    # Grab the collection-target associations...
-    logger.info("Loading collection_target associations...")
+    for row in rows('taxonomy'):
+        if row['id'] != 'id':
+            # Turn booleans into proper booleans:
+            tfs = ["publish"] # ie. ["publish", optional_boolean2, ..., optional_booleanN]
+            for tf in tfs:
+                if row[tf] == 't':
+                    row[tf] = True
+                else:
+                    row[tf] = False
+            # turn id into int
+            row['id'] = int(row['id'])
+            # Parse the timestamps once, here:
+            for f in TAXONOMY_DATE_FIELDS:
+                if f in row:
+                    row[f] = db_datetime(row[f])
+            tax[row['id']] = row
+    return tax
+
+
+def parse_links(rows, table, from_key, to_key):
+    # Association tables, as a list of (from, to) id pairs in their original order:
+    logger.info("Loading %s associations..." % table)
+    links = []
+    for row in rows(table):
+        if row[from_key] != from_key:
+            links.append((int(row[from_key]), int(row[to_key])))
+    return links
+
+
+def parse_watched(rows):
+    logger.info("Loading watched_target associations...")
+    watched = []
+    for row in rows('watched_target'):
+        if row['id'] != 'id':
+            watched.append((int(row['id_target']), row['document_url_scheme']))
+    return watched
+
+
+def parse_records(rows, table, unwanted):
+    logger.info("Loading %s records..." % table)
+    records = {}
+    for row in rows(table):
+        if row['id'] != 'id':
+            for f in unwanted:
+                row.pop(f, None)
+            # turn id into int
+            row['id'] = int(row['id'])
+            # Store
+            records[row['id']] = row
+    return records
+
+
+def join_tables(tables, workers=1):
+    targets = tables['target']
+    tax = tables['taxonomy']
+
+    # JOIN to get URLs:
+    logger.info("Joining URLs...")
+    for tid, position, url in tables.get('field_url', []):
+        if tid not in targets:
+            logger.warning(f"So such Target {tid} - no match for URL: {url}")
+            continue
+        urls = targets[tid].get('urls', [])
+        if position is not None:
+            urls.insert(position, url)
+        else:
+            urls.append(url)
+        targets[tid]['urls'] = urls
+
+    # Join the collection-target associations...
+    logger.info("Joining collection_target associations...")
     tid_cid = {}
-    with open(os.path.join(csv_dir,'collection_target.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['target_id'] != 'target_id':
-                tid = int(row['target_id'])
-                cid = int(row['collection_id'])
-                # Collections by Target
-                cids = tid_cid.get(tid, set())
-                cids.add(cid)
-                tid_cid[tid] = cids
-                # Targets by Collection
-                tids = tax[cid].get('target_ids', [])
-                tids.append(tid)
-                tax[cid]['target_ids'] = tids
-
-    # Grab the subjects
-    logger.info("Loading subject_target associations...")
+    for tid, cid in tables.get('collection_target', []):
+        # Collections by Target
+        cids = tid_cid.get(tid, set())
+        cids.add(cid)
+        tid_cid[tid] = cids
+        # Targets by Collection
+        tids = tax[cid].get('target_ids', [])
+        tids.append(tid)
+        tax[cid]['target_ids'] = tids
+
+    # Join the subjects
+    logger.info("Joining subject_target associations...")
     tid_sid = {}
-    with open(os.path.join(csv_dir,'subject_target.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['target_id'] != 'target_id':
-                tid = int(row['target_id'])
-                sid = int(row['subject_id'])
-                # Subjects by Target
-                sids = tid_sid.get(tid, set())
-                sids.add(sid)
-                tid_sid[tid] = sids
-                # Targets by Subject
-                tids = tax[sid].get('target_ids', [])
-                tids.append(tid)
-                tax[sid]['target_ids'] = tids
+    for tid, sid in tables.get('subject_target', []):
+        # Subjects by Target
+        sids = tid_sid.get(tid, set())
+        sids.add(sid)
+        tid_sid[tid] = sids
+        # Targets by Subject
+        tids = tax[sid].get('target_ids', [])
+        tids.append(tid)
+        tax[sid]['target_ids'] = tids
 
     # Also get the high-level 'collection areas'...
-    logger.info("Loading collection areas...")
+    logger.info("Joining collection areas...")
     caid_cid = {}
     collection_areas = {}
-    with open(os.path.join(csv_dir,'taxonomy_parents_all.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['taxonomy_id'] != 'taxonomy_id':
-                caid = int(row['taxonomy_id'])
-                cid = int(row['parent_id'])
-                # Collections  by Collection Area
-                cids = caid_cid.get(caid, [])
-                cids.append(cid)
-                caid_cid[caid] = cids
-                if caid not in collection_areas:
-                    collection_areas[caid] = {
-                        'id': caid,
-                        'name': tax[caid]['name'],
-                        'description': tax[caid]['description'],
-                        'collections': caid_cid[caid]
-                    }
-                # Add collection area to collection:
-                caids = tax[cid].get('collection_area_ids', [])
-                caids.append(caid)
-                tax[cid]['collection_area_ids'] = caids
+    for caid, cid in tables.get('taxonomy_parents_all', []):
+        # Collections  by Collection Area
+        cids = caid_cid.get(caid, [])
+        cids.append(cid)
+        caid_cid[caid] = cids
+        if caid not in collection_areas:
+            collection_areas[caid] = {
+                'id': caid,
+                'name': tax[caid]['name'],
+                'description': tax[caid]['description'],
+                'collections': caid_cid[caid]
+            }
+        # Add collection area to collection:
+        caids = tax[cid].get('collection_area_ids', [])
+        caids.append(caid)
+        tax[cid]['collection_area_ids'] = caids
 
     # Watched Target setup
-    logger.info("Loading watched_target associations...")
-    with open(os.path.join(csv_dir,'watched_target.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['id'] != 'id':
-                tid = int(row['id_target'])
-                targets[tid]['watched'] = True
-                targets[tid]['document_url_scheme'] = row['document_url_scheme']
+    logger.info("Joining watched_target associations...")
+    for tid, document_url_scheme in tables.get('watched_target', []):
+        targets[tid]['watched'] = True
+        targets[tid]['document_url_scheme'] = document_url_scheme
 
     # Licenses license_target table to Taxonomy table (yay American spelling!)
-    logger.info("Loading licenses...")
-    with open(os.path.join(csv_dir,'license_target.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            tid = int(row['target_id'])
-            licid = int(row['license_id'])
-            # License Names:
-            tlic = targets[tid].get('licenses', [])
-            tlic.append(tax[licid]['name'])
-            targets[tid]['licenses'] = tlic
-            # Also keep IDs:
-            tlic = targets[tid].get('license_ids', [])
-            tlic.append(licid)
-            targets[tid]['license_ids'] = tlic
-
-    # Grab the authors/curators:
-    logger.info("Loading creators...")
-    authors = {}
-    with open(os.path.join(csv_dir,'creator.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['id'] != 'id':
-                # Pop some unnecessary fields:
-                for f in ['password', 'url', 'edit_url', 'affiliation']:
-                    row.pop(f)
-                # turn id into int
-                row['id'] = int(row['id'])
-                # Store
-                authors[row['id']] = row
-
-    # Load the organisations:
-    logger.info("Loading organisations...")
-    orgs = {}
-    with open(os.path.join(csv_dir,'organisation.csv'), 'r') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            if row['id'] != 'id':
-                # Pop some unnecessary fields:
-                for f in ['author_id', 'url', 'edit_url', 'affiliation']:
-                    row.pop(f)
-                # turn id into int
-                row['id'] = int(row['id'])
-                # Store
-                orgs[row['id']] = row
+    logger.info("Joining licenses...")
+    for tid, licid in tables.get('license_target', []):
+        # License Names:
+        tlic = targets[tid].get('licenses', [])
+        tlic.append(tax[licid]['name'])
+        targets[tid]['licenses'] = tlic
+        # Also keep IDs:
+        tlic = targets[tid].get('license_ids', [])
+        tlic.append(licid)
+        targets[tid]['license_ids'] = tlic
+
+    # The authors/curators and the organisations:
+    authors = tables.get('creator', {})
+    orgs = tables.get('organisation', {})
 
     # JOIN to get
     #
@@ -288,22 +821,32 @@ def load_csv(csv_dir="./test/w3act-csv"):
     # To be OA need to must have (or inherit) a license
 
     # Extract the Collections heirarchy:
-    collections = extract_taxonomy(tax,'collections')
+    collections = None
+    if 'collection_target' in tables:
+        collections = extract_taxonomy(tax,'collections')
 
     # And the subjects:
-    subjects = extract_taxonomy(tax,'subject')
+    subjects = None
+    if 'subject_target' in tables:
+        subjects = extract_taxonomy(tax,'subject')
 
     # And the licences:
     licenses = extract_taxonomy(tax,'licenses')
 
-    # Post-processs the targets
-    oa_urls = set()
-    npld_urls = set()
+    # Work out the SURT of every seed just once, as they are also needed for any access lists:
+    surts = generate_surts((url for t in targets.values() for url in t.get('urls', [])), workers)
+
+    # Post-processs the targets, indexing the seeds of those that are NPLD or OA in their own right:
+    url_tokens = {}
+    oa_trie = SurtTrie()
+    npld_trie = SurtTrie()
     for tid in targets:
         # Collections:
-        targets[tid]['collection_ids'] = list(tid_cid.get(tid,[]))
+        if 'collection_target' in tables:
+            targets[tid]['collection_ids'] = list(tid_cid.get(tid,[]))
         # Subjects:
-        targets[tid]['subject_ids'] = list(tid_sid.get(tid,[]))
+        if 'subject_target' in tables:
+            targets[tid]['subject_ids'] = list(tid_sid.get(tid,[]))
         # QA Issues qaissue_id  Taxonomy
         qaid = targets[tid]['qaissue_id']
         targets[tid]['qaissue_score'] = 0
@@ -318,27 +861,35 @@ def load_csv(csv_dir="./test/w3act-csv"):
                 targets[tid]['qaissue_score'] = 3 # No QA Issues
         # NPLD status:
         targets[tid]['isNPLD'] = check_npld_status(targets[tid])
+        subdomains = targets[tid]['scope'] == 'subdomains'
+        for url in targets[tid].get('urls',[]):
+            if url not in url_tokens:
+                url_tokens[url] = surt_tokens(url, surts[url])
         if targets[tid]['isNPLD']:
             for url in targets[tid].get('urls',[]):
-                npld_urls.add(url)
+                npld_trie.add(url_tokens[url], tid, subdomains)
         # OA status:
         targets[tid]['isOA'] = check_oa_status(targets[tid])
         if targets[tid]['isOA']:
             for url in targets[tid].get('urls',[]):
-                oa_urls.add(url)
+                oa_trie.add(url_tokens[url], tid, subdomains)
 
-    # Second pass to add inherited statuses:
-    # FIXME Both should be inherited from all higher-level Targets. This version only inherits from hosts.
+    # Second pass to add statuses inherited from higher-level Targets, i.e. from the nearest
+    # other Target with that status whose seeds cover one of this Target's URLs:
     for tid in targets:
         for url in targets[tid].get('urls',[]):
-            parsed_uri = urlparse(url)
-            base = '{uri.scheme}://{uri.netloc}/'.format(uri=parsed_uri)
-            if base in oa_urls and not targets[tid]['isOA']:
-                targets[tid]['isOA'] = True
-                targets[tid]['inheritsOA'] = True
-            if base in npld_urls and not targets[tid]['isNPLD']:
-                targets[tid]['isNPLD'] = True
-                targets[tid]['inheritsNPLD'] = True
+            if not targets[tid]['isOA']:
+                ancestor = oa_trie.nearest(url_tokens[url], exclude=tid)
+                if ancestor is not None:
+                    targets[tid]['isOA'] = True
+                    targets[tid]['inheritsOA'] = True
+                    targets[tid]['inheritsOAFrom'] = ancestor
+            if not targets[tid]['isNPLD']:
+                ancestor = npld_trie.nearest(url_tokens[url], exclude=tid)
+                if ancestor is not None:
+                    targets[tid]['isNPLD'] = True
+                    targets[tid]['inheritsNPLD'] = True
+                    targets[tid]['inheritsNPLDFrom'] = ancestor
 
     # Perform some additional validation.
     invalid_tids = set()
@@ -370,10 +921,18 @@ def load_csv(csv_dir="./test/w3act-csv"):
         'licenses': licenses
     }
 
+    # Leaving out any entities that were not loaded:
+    for entity, needs in ENTITY_TABLES.items():
+        if entity in all and not set(needs).issubset(tables):
+            del all[entity]
+
     return all
 
 
-def filtered_targets(targets, frequency=None, terms='npld', include_hidden=True, omit_uk_tlds=False, include_expired=True):
+def filtered_targets(targets, frequency=None, terms='npld', include_hidden=True, omit_uk_tlds=False, include_expired=True, index=None):
+        # Use the TargetIndex if there is one, rather than scanning all the targets:
+        if index is not None:
+            return index.filter(frequency, terms, include_hidden, omit_uk_tlds, include_expired)
         # aggregate
         filtered = []
         for t in targets.values():
@@ -416,7 +975,7 @@ def filtered_targets(targets, frequency=None, terms='npld', include_hidden=True,
                 continue
             # Don't bother outputting expired items:
             if not include_expired and t['crawl_end_date']:
-                end_date = dateutil.parser.parse(t['crawl_end_date'])
+                end_date = as_datetime(t['crawl_end_date'])
                 if end_date < datetime.datetime.now():
                     date_delta = end_date - datetime.datetime.now()
                     logger.info("Skipping target %i '%s' with crawl end date in the past (%s)" %(t['id'], t['title'], date_delta))
@@ -472,93 +1031,144 @@ def remove_curator_info(targets, curators):
             continue
         curator_names.append(curator['name'])
 
+    # A single pattern matching any of the names, so most fields can be checked in one scan:
+    any_curator = None
+    if curator_names:
+        any_curator = re.compile("|".join(re.escape(curator_name) for curator_name in curator_names))
+
     for target in targets:
         target.pop('author_id', None)
+        if any_curator is None:
+            continue
         for key in target:
             if isinstance(target[key], str): # I originally checked against a specific list of fields but this is more robust and not much slower
                 if key == 'title': continue # occasional hit but shouldn't matter
+                if not any_curator.search(target[key]):
+                    continue
+                # Replace the names in turn, as one replacement can change what the next matches:
                 for curator_name in curator_names:
                     if curator_name in target[key]:
                         target[key] = target[key].replace(curator_name, 'the curator')
 
 
-# walk the collections (a tree of dictionaries and lists), replacing lists of target ids with target data
-def replace_target_ids_with_data(obj): 
-    if isinstance(obj, dict):
-        for k, v in obj.items():
-            if k == "target_ids":
-                denorm_targets = []
-                for target_id in obj[k]:
-                    try:
-                        denorm_targets.append(target_lookup[target_id]) # target_lookup is a global variable
-                    except KeyError: # not in valid target set
-                        for invalid_target in invalid_target_lookup: # global again
-                            if invalid_target['id'] == target_id:
-                                denorm_targets.append(invalid_target) 
-                                break
-                        else: # invalid target not found either
-                            logger.warning("Could not find target %i in target_lookup" % target_id)
-                            denorm_targets.append({'id': str(target_id), 'warning': '<Target Not In Result Set>'})
-                obj[k] = denorm_targets
-            elif isinstance(v, (dict, list)):
-                replace_target_ids_with_data(v)
-
-    elif isinstance(obj, list):
-        for item in obj:
-            replace_target_ids_with_data(item)
-
-
-def rename_key(iterable, before_key, after_key):
-    if isinstance(iterable, dict):
-        for key in list(iterable.keys()):
-            if key == before_key:
-                iterable[after_key] = iterable[before_key]
-                del iterable[key]
-        for obj in iterable:
-            rename_key(iterable[obj], before_key, after_key)
-    elif type(iterable) is list:
-        for obj in iterable:
-            rename_key(obj,before_key,after_key)
+def denormalise_collections(collections, targets, invalid_targets):
+    """
+    Returns a copy of each of the given collection trees, by collection ID, with the lists of
+    target_ids replaced by lists of the targets themselves, under 'targets'.
+
+    The collections are not modified, and the documents are built in one pass down the trees,
+    so each one can then be serialised independently.
+    """
+    # Look up the invalid targets by ID too:
+    invalid_targets_by_id = {}
+    for invalid_target in invalid_targets:
+        invalid_targets_by_id.setdefault(invalid_target['id'], invalid_target)
+
+    def lookup(target_id):
+        target = targets.get(target_id, None)
+        if target is None:
+            target = invalid_targets_by_id.get(target_id, None)
+        if target is None: # invalid target not found either
+            logger.warning("Could not find target %i in target_lookup" % target_id)
+            target = {'id': str(target_id), 'warning': '<Target Not In Result Set>'}
+        return target
+
+    def denormalise(collection):
+        doc = {}
+        for key, value in collection.items():
+            if key != 'target_ids':
+                doc[key] = value
+        if 'target_ids' in collection:
+            doc['targets'] = [lookup(target_id) for target_id in collection['target_ids']]
+        return doc
+
+    # Work down the trees with a stack, rather than by recursion:
+    documents = {}
+    stack = []
+    for cid, collection in collections.items():
+        documents[cid] = denormalise(collection)
+        stack.append(documents[cid])
+    while stack:
+        doc = stack.pop()
+        if 'children' in doc:
+            doc['children'] = [denormalise(child) for child in doc['children']]
+            stack.extend(doc['children'])
+    return documents
+
 
 def clear_unpublished_collections(collection):
     logger.info(f"Looking to clear unpublished collections in collection: {collection['name']}...")
     # If this collection should not be published, signal that it should be dropped:
     if collection['publish'] == False:
         return None
-    else:
-        # Accept the collection, and process the child collections:
+    # Otherwise accept the collection, and work down through the child collections:
+    stack = [collection]
+    while stack:
+        accepted = stack.pop()
         new_children = []
-        for child in collection['children']:
-            new_child = clear_unpublished_collections(child)
-            if new_child != None:
-                new_children.append(new_child)
-        collection['children'] = new_children
-        return collection
-
-def csv_to_api_json(target_data, invalid_target_data, collection_data, curators, output_dir='/tmp/test'):
-
-    global target_lookup, invalid_target_lookup  
-    target_lookup = target_data   
-    invalid_target_lookup = invalid_target_data   
+        for child in accepted['children']:
+            logger.info(f"Looking to clear unpublished collections in collection: {child['name']}...")
+            if child['publish'] != False:
+                new_children.append(child)
+        accepted['children'] = new_children
+        stack.extend(reversed(new_children))
+    return collection
+
+def gzip_bytes(data):
+    # Compress with a fixed timestamp, so the same data always gives the same bytes
+    # (gzip.compress only takes an mtime from Python 3.8):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def write_if_changed(file_path, data, incremental=False):
+    # Write the data atomically, unless in incremental mode and the file already holds exactly that:
+    if incremental and os.path.exists(file_path) \
+            and file_sha256(file_path) == hashlib.sha256(data).hexdigest():
+        return False
+    with open(file_path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(file_path + '.tmp', file_path)
+    return True
+
+
+def csv_to_api_json(target_data, invalid_target_data, collection_data, curators, output_dir='/tmp/test', incremental=False, gzip_output=False):
 
     # remove private curatorial data from targets 
     # (targets and invalid_targets are slightly different data structures)
-    remove_curator_info(target_lookup.values(), curators.values())
-    remove_curator_info(invalid_target_lookup, curators.values())
+    remove_curator_info(target_data.values(), curators.values())
+    remove_curator_info(invalid_target_data, curators.values())
 
     logger.info("Replacing lists of target_ids with lists of targets...")
-    # replace ids with data via a nested (recursive) update
-    replace_target_ids_with_data(collection_data)
-    # now rename the keys themselves, similar method
-    rename_key(collection_data, "target_ids", "targets")
+    collection_docs = denormalise_collections(collection_data, target_data, invalid_target_data)
 
     # save the collections with newly expanded target data into one file per collection
     output_dir = output_dir + '/collection/'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for k,v in collection_data.items():
+    written = 0
+    for k,v in collection_docs.items():
         logger.info(f"Writing json file for collection {k}")
-        with open(output_dir  + str(k) + '.json', 'w') as f:
-            json.dump(v, f, indent=4, sort_keys=True)
+        data = json.dumps(v, indent=4, sort_keys=True, default=to_json).encode('utf-8')
+        changed = write_if_changed(output_dir + str(k) + '.json', data, incremental)
+        if gzip_output:
+            # With a fixed timestamp, so the compressed file only changes when the JSON does:
+            gz_file = output_dir + str(k) + '.json.gz'
+            if changed or not os.path.exists(gz_file):
+                write_if_changed(gz_file, gzip_bytes(data))
+        if changed:
+            written += 1
+    logger.info(f"Written {written} of {len(collection_docs)} collection files.")
+
+    # Remove the files of any collections that are no longer there:
+    if incremental:
+        wanted = set(str(k) for k in collection_docs)
+        for file_name in os.listdir(output_dir):
+            m = re.match(r'^(\d+)\.json(\.gz)?$', file_name)
+            if m and (m.group(1) not in wanted or (m.group(2) and not gzip_output)):
+                logger.info(f"Removing stale file {file_name}...")
+                os.remove(output_dir + file_name)
 
@@ -10,16 +10,23 @@ import psycopg2
 import logging
 from urllib.parse import urlparse
 import shutil
+import filecmp
 import json
+import io
 import csv
 import sys
 import os
 import re
-from w3act.dbc.client import get_csv, load_csv, filtered_targets, filtered_collections, csv_to_zip, to_crawl_feed_format, csv_to_api_json
-from w3act.dbc.generate.acls import generate_acl
+from w3act.dbc.client import get_csv, load_csv, load_db, filtered_targets, filtered_collections, csv_to_zip, to_crawl_feed_format, csv_to_api_json
+from w3act.dbc.index import ScheduleIndex
+from w3act.dbc.acl_index import AclIndex
+from w3act.dbc.generate.acls import generate_acl, write_acl, diff_sorted, read_acl
 from w3act.dbc.generate.annotations import generate_annotations
 from w3act.dbc.generate.collections_solr import populate_collections_solr
 from w3act.dbc.generate.site import GenerateSitePages
+from w3act.dbc.generate.sqlite import generate_sqlite
+from w3act.dbc.generate.parquet import generate_parquet
+from w3act.dbc.generate.json_stream import iter_json, iter_jsonl
 
 # Set up overall logging config:
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s: %(levelname)s - %(name)s - %(message)s')
@@ -27,52 +34,116 @@ logging.basicConfig(level=logging.WARNING, format='%(asctime)s: %(levelname)s -
 # Set up logger for this module:
 logger = logging.getLogger(__name__)
 
+# The parts of the data model each action needs, so the rest need not be loaded when the model
+# cache is not in use (the cache always holds everything). Actions that are not listed here
+# load everything:
+ACTION_ENTITIES = {
+    'list-urls': ['urls', 'licenses', 'watched'],
+    'crawl-feed': ['urls', 'licenses', 'watched'],
+    'gen-oa-acl': ['urls', 'licenses'],
+    'gen-annotations': ['urls', 'collections', 'subjects', 'collection_areas'],
+}
+
 def write_json(filename, all, format='json', include_w3act_type=True):
+    # Both formats are encoded and written out one entity at a time:
     if format == 'json':
         with OutputFileOrStdout(filename) as f:
-            json.dump(all, f, indent=2)
+            f.writelines(iter_json(all))
     elif format == 'jsonl':
         with OutputFileOrStdout(filename) as f:
-            for w3act_type in all:
-                if w3act_type != "invalid_targets":
-                    logger.debug(f"Looking at w3act_type={w3act_type}")
-                    for item_key in all[w3act_type]:
-                        item = all[w3act_type][item_key]
-                        if include_w3act_type:
-                            item['w3act_type'] = w3act_type
-                        json.dump(item,f)
-                        f.write('\n')
-                else:
-                    for item in all[w3act_type]:
-                        if include_w3act_type:
-                            item['w3act_type'] = w3act_type
-                        json.dump(item,f)
-                        f.write('\n')
+            f.writelines(iter_jsonl(all, include_w3act_type))
     else:
         raise Exception(f"Unknown format {format}!")
 
 def write_sqlite(filename, all):
     if filename == '-':
         raise Exception("Can't write SQLite to output stream.")
-    import pandas as pd
-    import os.path
-    from sqlalchemy import create_engine
-    # Set up DB:
     file_path = os.path.abspath(filename)
     logger.info(f"Writing to {file_path}...")
-    engine = create_engine(f"sqlite:///{file_path}", echo=False)
-    # Process entries:
-    for w3act_type in all:
-        items = []
-        if w3act_type != "invalid_targets":
-            for item_key in all[w3act_type]:
-                item = all[w3act_type][item_key]
-                items.append(item)
+    generate_sqlite(all, file_path)
+
+def write_parquet(output_dir, all):
+    dir_path = os.path.abspath(output_dir)
+    logger.info(f"Writing to {dir_path}...")
+    generate_parquet(all, dir_path)
+
+def write_access_list(args, targets, include_cdns, output_file=None):
+    with OutputFileOrStdout(output_file or args.output_file) as f:
+        if args.sort_memory_mb:
+            # Sort on disk, so large lists don't need to fit in memory:
+            write_acl(f, targets, include_cdns, fmt=args.format, compact=args.compact_acl,
+                      max_memory=args.sort_memory_mb * 1024 * 1024)
         else:
-            items = all[w3act_type]
-        # Load into pandas
-        df = pd.DataFrame(items)
-        df.to_sql(w3act_type, con=engine, if_exists='replace')
+            for line in generate_acl(targets, include_cdns, fmt=args.format, compact=args.compact_acl):
+                f.write("%s\n" % line)
+
+def write_access_list_changes(args, targets, include_cdns):
+    # Write the new list alongside the old one first, so the two can be compared:
+    new_file = args.output_file + '.tmp'
+    write_access_list(args, targets, include_cdns, new_file)
+
+    # Then write out the differences, with a sorted merge of the two lists, only replacing
+    # the previous change files once all of them have been written:
+    added = 0
+    removed = 0
+    if not os.path.exists(args.previous_acl):
+        logger.warning(f"Previous access list {args.previous_acl} not found, so treating every rule as added.")
+    added_file = args.output_file + '.added'
+    removed_file = args.output_file + '.removed'
+    try:
+        with open(args.previous_acl) if os.path.exists(args.previous_acl) else io.StringIO() as f_old, \
+                open(new_file) as f_new, \
+                open(added_file + '.tmp', 'w') as f_added, \
+                open(removed_file + '.tmp', 'w') as f_removed:
+            for change, line in diff_sorted(read_acl(f_old), read_acl(f_new), reverse=(args.format == 'pywb')):
+                if change == '+':
+                    f_added.write("%s\n" % line)
+                    added += 1
+                else:
+                    f_removed.write("%s\n" % line)
+                    removed += 1
+    except Exception:
+        for tmp_file in [new_file, added_file + '.tmp', removed_file + '.tmp']:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        raise
+    os.replace(added_file + '.tmp', added_file)
+    os.replace(removed_file + '.tmp', removed_file)
+    print("%i rules added and %i removed since %s" % (added, removed, args.previous_acl))
+
+    # Leave the output untouched if it is already up to date, so it need not be redeployed:
+    if os.path.exists(args.output_file) and filecmp.cmp(new_file, args.output_file, shallow=False):
+        logger.info(f"{args.output_file} is unchanged.")
+        os.remove(new_file)
+    else:
+        os.replace(new_file, args.output_file)
+
+def check_urls(acl_file, urls):
+    with AclIndex(acl_file) as acl:
+        for url in urls:
+            if not url:
+                continue
+            try:
+                rule = acl.match(url)
+            except Exception as e:
+                logger.warning(f"Could not look up {url}: {e}")
+                print("%s\terror\t-" % url)
+                continue
+            print("%s\t%s\t%s" % (url, acl.access(rule), rule or '-'))
+
+def get_db_params(args):
+    # Setup connection params
+    params = {
+        'password': os.environ.get("W3ACT_PSQL_PASSWORD", None),
+        'database': args.db_name,
+        'user': args.db_user,
+        'host': args.db_host,
+        'port': args.db_port
+    }
+    # make command-line pw override any env var:
+    if args.db_pw:
+        params['password'] = args.db_pw
+    return params
 
 class OutputFileOrStdout():
     def __init__(self, output_file):
@@ -87,10 +158,26 @@ class OutputFileOrStdout():
         if self.writer is not sys.stdout:
             self.writer.close()        
 
+def due_datetime(value):
+    # Crawl dates are stored without a timezone, as UTC, so any given timezone is converted to that:
+    value = dateutil.parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
 def main():
     common_parser = argparse.ArgumentParser(add_help=False)
     common_parser.add_argument('-v', '--verbose',  action='count', default=0, help='Logging level; add more -v for more logging.')
     common_parser.add_argument('-d', '--csv-dir', dest='csv_dir', help="Folder to cache CSV data in.", default="w3act-db-csv")
+    common_parser.add_argument('--no-model-cache', dest='use_model_cache', action='store_false', default=True,
+                        help="Don't use or update the binary snapshot of the loaded data kept in the CSV folder, "
+                             "which is rebuilt automatically whenever the CSV files change.")
+    common_parser.add_argument('--project', dest='project', action='store_true', default=False,
+                        help="Only download or load the tables and columns that the w3act tools use "
+                             "(see w3act.dbc.schema), rather than everything. [default: %(default)s]")
+    common_parser.add_argument('--compact', dest='compact', action='store_true', default=False,
+                        help="Hold targets in memory as compact, typed records rather than plain dicts, "
+                             "which uses much less memory. [default: %(default)s]")
 
     target_filter_parser = argparse.ArgumentParser(add_help=False)
     target_filter_parser.add_argument('-f', '--frequency', dest="frequency", type=str,
@@ -122,6 +209,31 @@ def main():
     collection_filter_parser.add_argument('--include-unpublished-collections', dest='include_unpublished', action='store_true', default=False,
                         help='Include collections that are marked "not for publishing". [default: %(default)s]')
 
+    # Database connection details:
+    db_parser = argparse.ArgumentParser(add_help=False)
+    db_parser.add_argument('-H', '--db-host', dest='db_host',
+                    type=str, default="localhost",
+                    help="Hostname of W3ACT PostgreSQL database [default: %(default)s]" )
+    db_parser.add_argument('-P', '--db-port', dest='db_port',
+                    type=int, default=5432,
+                    help="Port number of W3ACT PostgreSQL database [default: %(default)s]" )
+    db_parser.add_argument('-u', '--db-user', dest='db_user',
+                    type=str, default="w3act",
+                    help="Database user to login with [default: %(default)s]" )
+    db_parser.add_argument('-p', '--db-pw', dest='db_pw',
+                    type=str, default=None,
+                    help="Database user password [default: %(default)s]" )
+    db_parser.add_argument('-D', '--db-name', dest='db_name',
+                    type=str, default="w3act",
+                    help="Name of the W3ACT PostgreSQL database [default: %(default)s]" )
+
+    # Whether to load the data straight from the database rather than from the CSV files:
+    source_parser = argparse.ArgumentParser(add_help=False, parents=[db_parser])
+    source_parser.add_argument('--from-db', dest='from_db', action='store_true', default=False,
+                        help='Load the data directly from the W3ACT PostgreSQL database, rather than from the CSV folder. [default: %(default)s]')
+    source_parser.add_argument('--load-workers', dest='load_workers', type=int, default=1,
+                        help='Number of processes to parse the CSV files over in parallel when loading them. [default: %(default)s]')
+
 #  npld_only=True, frequency=None,
     # omit_hidden=True,
     # omit_uk_tlds=False
@@ -135,81 +247,115 @@ def main():
     # Get CSV
     get_parser = subparsers.add_parser("get-csv", 
         help="Download data from W3ACT PostgreSQL and store as CSV.",
-        parents=[common_parser])
-    get_parser.add_argument('-H', '--db-host', dest='db_host',
-                    type=str, default="localhost",
-                    help="Hostname of W3ACT PostgreSQL database [default: %(default)s]" )
-    get_parser.add_argument('-P', '--db-port', dest='db_port',
-                    type=int, default=5432,
-                    help="Port number of W3ACT PostgreSQL database [default: %(default)s]" )
-    get_parser.add_argument('-u', '--db-user', dest='db_user',
-                    type=str, default="w3act",
-                    help="Database user to login with [default: %(default)s]" )
-    get_parser.add_argument('-p', '--db-pw', dest='db_pw',
-                    type=str, default=None,
-                    help="Database user password [default: %(default)s]" )
-    get_parser.add_argument('-D', '--db-name', dest='db_name',
-                    type=str, default="w3act",
-                    help="Name of the W3ACT PostgreSQL database [default: %(default)s]" )
+        parents=[common_parser, db_parser])
+    get_parser.add_argument('-w', '--workers', dest='workers',
+                    type=int, default=1,
+                    help="Number of database connections to download tables over in parallel, "
+                         "all reading the same consistent snapshot [default: %(default)s]" )
+    get_parser.add_argument('--delta', dest='delta', action='store_true', default=False,
+                    help="Only download rows that have changed since the last run (as recorded in the manifest), "
+                         "merging them into the existing CSV files. Tables without 'id' and 'updated_at' columns "
+                         "are always downloaded in full. [default: %(default)s]" )
+    get_parser.add_argument('-z', '--compress', dest='compression',
+                    type=str, default=None, choices=['gzip', 'zstd'],
+                    help="Compress the CSV files as they are downloaded (zstd needs the 'zstandard' package). "
+                         "Compressed files are read directly by all the other commands. [default: %(default)s]" )
 
     # Turn to JSON
     to_json_parser = subparsers.add_parser("csv-to-json", 
         help="Load CSV and store as JSON.",
-        parents=[common_parser, collection_filter_parser])
+        parents=[common_parser, source_parser, collection_filter_parser])
 
     to_jsonl_parser = subparsers.add_parser("csv-to-jsonl", 
         help="Load CSV and store as JSON Lines.",
-        parents=[common_parser, collection_filter_parser])
+        parents=[common_parser, source_parser, collection_filter_parser])
 
     to_sqlite_parser = subparsers.add_parser("csv-to-sqlite", 
-        help="Load CSV and store as a SQLite database. !!! WARNING: This is a work-in-progress and is currently broken!!!",
-        parents=[common_parser, collection_filter_parser])
+        help="Load CSV and store as a normalised SQLite database, with indexes and full-text search over target titles and descriptions.",
+        parents=[common_parser, source_parser, collection_filter_parser])
+
+    to_parquet_parser = subparsers.add_parser("csv-to-parquet", 
+        help="Load CSV and store as typed Parquet files, one per table, for analytics (needs the 'pyarrow' package).",
+        parents=[common_parser, source_parser, collection_filter_parser])
+    to_parquet_parser.add_argument('-o', '--parquet-output-dir', dest='parquet_output_dir', default=None,
+                    help="Output directory for the Parquet files. [default: the CSV directory name plus '-parquet']")
+
+    to_zip_parser = subparsers.add_parser("csv-to-zip", 
+        help="Bundle the CSV files into a single ZIP file.",
+        parents=[common_parser])
 
     to_api_json_parser = subparsers.add_parser("csv-to-api-json", 
         help="Load CSV and store collections as separate JSON files.",
-        parents=[common_parser, collection_filter_parser])
+        parents=[common_parser, source_parser, collection_filter_parser])
     to_api_json_parser.add_argument('-o', '--api-output-dir', dest='api_output_dir', help="Output directory for files retrieved from API", default="api_json")
+    to_api_json_parser.add_argument('--incremental', action='store_true', default=False,
+                    help="Only rewrite the collection files whose content has changed, and remove those of collections that are no longer included. [default: %(default)s]")
+    to_api_json_parser.add_argument('--gzip', dest='gzip_output', action='store_true', default=False,
+                    help="Also write a pre-compressed .json.gz copy of each collection file. [default: %(default)s]")
 
     # Create
     urllist_parser = subparsers.add_parser("list-urls", 
         help="List URLs from Targets in the W3ACT CSV data.",
-        parents=[common_parser, target_filter_parser])
+        parents=[common_parser, source_parser, target_filter_parser])
     urllist_parser.add_argument('-F', '--format', choices=['pywb','surts','urls'], help="The file format to write: 'pywb' for the pywb aclj format, 'surts' for a sorted list of SURT prefixes, or 'urls' for plain URLs.", default='urls')
+    urllist_parser.add_argument('--compact-acl', dest='compact_acl', action='store_true', default=False,
+                    help="Drop any SURT prefixes or access rules that are already covered by a shorter one (not used for plain URLs). [default: %(default)s]")
+    urllist_parser.add_argument('--sort-memory-mb', dest='sort_memory_mb', type=int, default=None,
+                    help="Sort the output using temporary files, keeping memory use to around this many MB, rather than sorting it all in memory. [default: %(default)s]")
     urllist_parser.add_argument('output_file', type=str, help="File to write output path to.")
 
     # Generate crawl feed
     crawlfeed_parser = subparsers.add_parser("crawl-feed",
         help="Generate crawl-feed format files from W3ACT CSV data.",
-        parents=[common_parser, target_filter_parser])
+        parents=[common_parser, source_parser, target_filter_parser])
     crawlfeed_parser.add_argument('-F', '--format', 
         choices=['json','jsonl'], 
         help="The file format to write: 'json' for one large json file, 'jsonl' for JSONLines.", 
         default='json')
+    crawlfeed_parser.add_argument('--due-from', dest='due_from', type=due_datetime, default=None,
+        help="Only include targets with a crawl due at or after this date/time, according to their crawl start date and frequency. Needs --due-to.")
+    crawlfeed_parser.add_argument('--due-to', dest='due_to', type=due_datetime, default=None,
+        help="Only include targets with a crawl due before this date/time. Needs --due-from.")
     crawlfeed_parser.add_argument('output_file', type=str, help="File to write output to.")
 
     # Generate access lists
     acl_parser = subparsers.add_parser("gen-oa-acl", 
         help="Generate open access surts/aclj from W3ACT CSV data.",
-        parents=[common_parser])
+        parents=[common_parser, source_parser])
     acl_parser.add_argument('-F', '--format', choices=['pywb','surts'], help="The file format to write: 'pywb' for the pywb aclj format, or 'surts' for a sorted list of SURT prefixes.", default='pywb')
+    acl_parser.add_argument('--compact-acl', dest='compact_acl', action='store_true', default=False,
+                    help="Drop any SURT prefixes or access rules that are already covered by a shorter one. [default: %(default)s]")
+    acl_parser.add_argument('--sort-memory-mb', dest='sort_memory_mb', type=int, default=None,
+                    help="Sort the output using temporary files, keeping memory use to around this many MB, rather than sorting it all in memory. [default: %(default)s]")
+    acl_parser.add_argument('--previous-acl', dest='previous_acl', default=None,
+                    help="A previous version of the access list, in the same format. The rules added and removed since then are written to the output file name plus '.added' and '.removed', and the output file is only replaced if it has changed.")
     acl_parser.add_argument('output_file', type=str, help="File to write output path to.")
 
+    # Check URLs against an access list:
+    check_parser = subparsers.add_parser("check-url", 
+        help="Look up URLs in an access list generated by list-urls or gen-oa-acl (in the pywb or surts format), "
+             "printing each URL, its access (or 'in' for SURT prefixes, 'none' if nothing matches) and the matching rule. "
+             "The CSV data is not needed.",
+        parents=[common_parser])
+    check_parser.add_argument('acl_file', type=str, help="The access list file to look the URLs up in.")
+    check_parser.add_argument('urls', nargs='*', help="URLs to check. If none are given, they are read from stdin, one per line.")
+
     # Generate annotations for full-text search indexing:
     ann_parser = subparsers.add_parser("gen-annotations", 
         help="Generate search annotations from W3ACT CSV data.",
-        parents=[common_parser, collection_filter_parser])
+        parents=[common_parser, source_parser, collection_filter_parser])
     ann_parser.add_argument('output_file', type=str, help="File to write output path to.")
 
     # Generate static site version
     sitegen_parser = subparsers.add_parser("gen-site", 
         help="Generate Hugo static site source files from W3ACT CSV data.",
-        parents=[common_parser, collection_filter_parser])
+        parents=[common_parser, source_parser, collection_filter_parser])
     sitegen_parser.add_argument('output_dir', type=str, help="Directory to output to.")
 
     # Update a collections Solr instance
     colsol_parser = subparsers.add_parser("update-collections-solr", 
         help="Update ukwa-ui-collections-solr instance with these targets and collections.",
-        parents=[common_parser, collection_filter_parser])
+        parents=[common_parser, source_parser, collection_filter_parser])
     colsol_parser.add_argument('solr_url', type=str, help="The Solr URL for the ukwa-ui-collections-solr index to populate, e.g. http://host:8983/solr/collection")
 
     # Parse up:
@@ -231,21 +377,23 @@ def main():
     if hasattr(args, 'api_output_dir'):
         args.api_output_dir = args.api_output_dir.rstrip('/')
 
+    if getattr(args, 'due_from', None) or getattr(args, 'due_to', None):
+        if not (args.due_from and args.due_to):
+            parser.error("--due-from and --due-to must be used together")
+        if args.due_from >= args.due_to:
+            parser.error("--due-from must be before --due-to")
+
+    if getattr(args, 'previous_acl', None) and args.output_file == '-':
+        parser.error("--previous-acl needs an output file, rather than '-'")
+
     # Handle:
     if args.action == "get-csv":
-        # Setup connection params
-        params = {
-            'password': os.environ.get("W3ACT_PSQL_PASSWORD", None),
-            'database': args.db_name,
-            'user': args.db_user,
-            'host': args.db_host,
-            'port': args.db_port
-        }
-        # make command-line pw override any env var:
-        if args.db_pw:
-            params['password'] = args.db_pw
-        # And pull down the data tables as CSV:
-        get_csv(csv_dir=args.csv_dir, params=params)
+        # Pull down the data tables as CSV:
+        get_csv(csv_dir=args.csv_dir, params=get_db_params(args), workers=args.workers, delta=args.delta, compression=args.compression, project=args.project)
+    elif args.action == "csv-to-zip":
+        print(csv_to_zip(args.csv_dir))
+    elif args.action == "check-url":
+        check_urls(args.acl_file, args.urls or (line.strip() for line in sys.stdin))
     else:
         # Fail if args.action is empty
         if not args.action:
@@ -253,8 +401,12 @@ def main():
             return
 
         # Load in for processing:
+        entities = ACTION_ENTITIES.get(args.action, None)
         try:
-            all = load_csv(csv_dir=args.csv_dir)            
+            if args.from_db:
+                all = load_db(params=get_db_params(args), project=args.project, compact=args.compact, entities=entities)
+            else:
+                all = load_csv(csv_dir=args.csv_dir, use_cache=args.use_model_cache, project=args.project, compact=args.compact, workers=args.load_workers, entities=entities)
         except ValueError as err:
             print(err)
             return
@@ -267,6 +419,7 @@ def main():
             "csv-to-json",
             "csv-to-jsonl",
             "csv-to-sqlite",
+            "csv-to-parquet",
             "csv-to-api-json"
             ]:
             matching_collections = filtered_collections(all['collections'], args.include_unpublished)
@@ -285,12 +438,14 @@ def main():
 
         # Actions to perform:
         if args.action  == "list-urls":
-            results = generate_acl(matching_targets, False, fmt=args.format)
-            with OutputFileOrStdout(args.output_file) as f:
-                for line in results:
-                    f.write("%s\n" % line)
+            write_access_list(args, matching_targets, False)
 
         elif args.action == "crawl-feed":
+            # Only keep the targets that are due in the given range:
+            if args.due_from:
+                due = ScheduleIndex(all['targets']).due(args.due_from, args.due_to)
+                due_ids = set(target['id'] for target in due)
+                matching_targets = [target for target in matching_targets if target['id'] in due_ids]
             feed = {}
             feed['targets'] = {}
             for target in matching_targets:
@@ -302,10 +457,10 @@ def main():
             # Generate Open Access targets subset:
             oa_targets = filtered_targets(all['targets'], frequency='all', terms='oa', include_expired=True, include_hidden=False)
             # Generate the OA list:
-            acls = generate_acl(oa_targets, True, fmt=args.format)
-            with OutputFileOrStdout(args.output_file) as f:
-                for line in acls:
-                    f.write("%s\n" % line)
+            if args.previous_acl:
+                write_access_list_changes(args, oa_targets, True)
+            else:
+                write_access_list(args, oa_targets, True)
 
         elif args.action == "gen-annotations":
             # Pass on unfiltered targets etc.
@@ -341,8 +496,8 @@ def main():
         elif args.action == "csv-to-sqlite":
             write_sqlite("%s.sqlite" % args.csv_dir, all)
 
-        elif args.action == "csv-to-zip":
-            csv_to_zip(args.csv_dir)
+        elif args.action == "csv-to-parquet":
+            write_parquet(args.parquet_output_dir or "%s-parquet" % args.csv_dir, all)
 
         elif args.action == "csv-to-api-json":
             csv_to_api_json(
@@ -350,7 +505,9 @@ def main():
                 all['invalid_targets'], 
                 matching_collections, 
                 all['curators'],
-                args.api_output_dir
+                args.api_output_dir,
+                incremental=args.incremental,
+                gzip_output=args.gzip_output
                 )
         else:
             print("No known action specified! Use -h flag to see available actions.")
@@ -3,7 +3,12 @@ import json
 import shutil
 import logging
 import datetime
+import tempfile
+import heapq
+import sys
 import surt
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -76,7 +81,71 @@ CDN_SURTS = [
 ]
 
 
+# The same seeds are converted for every index and access list built from a model, so the most
+# recently used SURTs are kept, up to this many, or all the seeds passed to generate_surts if more:
+SURT_CACHE_SIZE = 1 << 18
+
+_surt_cache = OrderedDict()
+_surt_cache_size = SURT_CACHE_SIZE
+
+
+def _remember_surt(url, surtVal):
+    _surt_cache[url] = surtVal
+    if len(_surt_cache) > _surt_cache_size:
+        _surt_cache.popitem(last=False)
+
+
 def generate_surt(url):
+    # Use the cached SURT if there is one:
+    if url in _surt_cache:
+        _surt_cache.move_to_end(url)
+        return _surt_cache[url]
+    surtVal = compute_surt(url)
+    _remember_surt(url, surtVal)
+    return surtVal
+
+
+def generate_surts(urls, workers=1, chunksize=1000):
+    # The SURTs of all the given URLs, by URL, working out any that are not already cached
+    # across a pool of processes if requested, and caching them all for generate_surt:
+    global _surt_cache_size
+    surts = {}
+    missing = {}
+    for url in urls:
+        if url in surts or url in missing:
+            continue
+        if url in _surt_cache:
+            surts[url] = generate_surt(url)
+        else:
+            missing[url] = None
+    missing = list(missing)
+    # Make room for all of them, as otherwise the same seeds would keep pushing each other out
+    # whenever they are all looked up again in the same order:
+    _surt_cache_size = max(_surt_cache_size, len(surts) + len(missing))
+    if workers > 1 and len(missing) > chunksize:
+        logger.info("Generating %i SURTs using %i processes..." % (len(missing), workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            values = list(executor.map(compute_surt, missing, chunksize=chunksize))
+    else:
+        values = [compute_surt(url) for url in missing]
+    for url, surtVal in zip(missing, values):
+        _remember_surt(url, surtVal)
+        surts[url] = surtVal
+    return surts
+
+
+def compute_surt(url):
+    # The canonical SURT for the URL, without caching:
+    surtVal = url_surt(url)
+
+    # If it ends with )/, open it up to subdomains by ending with a , instead:
+    surtVal = re.sub(r'\)/$', ',', surtVal)
+
+    return surtVal
+
+
+def url_surt(url):
+    # The SURT of the URL itself, with the http:// scheme, e.g. for looking it up in access lists:
     surtVal = surt.surt(url)
 
     #### WA: ensure SURT has scheme of original URL ------------
@@ -94,26 +163,60 @@ def generate_surt(url):
             surtVal = line_scheme + '(' + surtVal
             # logger.debug("Added scheme [%s] and ( to surt [%s]" % (line_scheme, surtVal))
 
-    # If it ends with )/, open it up to subdomains by ending with a , instead:
-    surtVal = re.sub(r'\)/$', ',', surtVal)
-
     return surtVal
 
 
-def generate_acl(targets, include_cdns, fmt="pywb"):
-    # collate surts
-    all_urls = set()
-    all_surts = set()
-    all_surts_and_urls = list()
+def iter_compacted(items, key=lambda item: item, what="entries"):
+    # Drop any items whose key is covered by a different, shorter key that is a prefix of it.
+    # The items must already be sorted by key, so everything a prefix covers comes straight
+    # after it, and each key only needs checking against the last one kept. Items with the
+    # same key are all kept.
+    last = None
+    total = 0
+    removed = 0
+    for item in items:
+        total += 1
+        k = key(item)
+        if last is not None and k != last and k.startswith(last):
+            removed += 1
+            continue
+        yield item
+        last = k
+    # Reported even without --verbose, as this is the summary --compact-acl asks for. It goes to
+    # stderr via logging rather than being printed, as the list itself may be going to stdout:
+    logger.warning("Compaction removed %i of %i %s." % (removed, total, what))
+
+
+def compact_prefixes(items, key=lambda item: item, what="entries"):
+    return list(iter_compacted(sorted(items, key=lambda item: (key(item), item)), key, what))
+
+
+def pywb_rule_key(rule):
+    return rule.split(' ', 1)[0]
+
+
+def pywb_rule(surt, url):
+    rule = {
+        'access': 'allow',
+        'url': url
+    }
+    surt = surt.replace('http://(', '', 1)
+    surt = surt.rstrip(',') # Strip any trailing comma
+    return "%s - %s" % (surt, json.dumps(rule))
+
 
-    if include_cdns == True:
+def iter_acl_entries(targets, include_cdns, fmt="pywb"):
+    # The lines of the access list, in no particular order and possibly repeated:
+    if fmt not in ["urls", "surts", "pywb"]:
+        raise Exception("Unknown access list format '%s'!" % fmt)
+
+    if include_cdns == True and fmt != "urls":
         # Start with allowing all from know CDNs:
         for cdn_surt in CDN_SURTS:
-            all_surts.add(cdn_surt)
-            all_surts_and_urls.append({
-                'surt': cdn_surt,
-                'url': cdn_surt
-            })
+            if fmt == "surts":
+                yield cdn_surt
+            else:
+                yield pywb_rule(cdn_surt, cdn_surt)
         logger.info("%s surts for CDNs added" % len(CDN_SURTS))
 
     # Add SURTs from ACT:
@@ -127,6 +230,11 @@ def generate_acl(targets, include_cdns, fmt="pywb"):
                 logger.warn("Nonsense URL [%s] in target %i" % (seed, target['id']))
                 continue
 
+            # Record as URL
+            if fmt == "urls":
+                yield seed
+                continue
+
             # Generate SURT, cap it depending on scope:
             act_surt = generate_surt(seed)
             if act_surt is not None:
@@ -140,35 +248,135 @@ def generate_acl(targets, include_cdns, fmt="pywb"):
                     else:
                         logger.debug("Leaving alone: " + scope + " " + act_surt)
                 # Store the SURT:
-                all_surts.add(act_surt)
-                all_surts_and_urls.append({
-                    'surt': act_surt,
-                    'url': seed
-                })
+                if fmt == "surts":
+                    yield act_surt
+                else:
+                    yield pywb_rule(act_surt, seed)
             else:
                 logger.warning("Got no SURT from %s" % seed)
 
-            # Record as URL
-            all_urls.add(seed)
-
-    # And write out the SURTs:
-    if fmt == "urls":
-        return sorted(all_urls)
-    elif fmt == "surts":
-        return sorted(all_surts)
-    elif fmt == "pywb":
-        # Return as a pywb acl list:
-        pywb_rules = set()
-        for item in all_surts_and_urls:
-            rule = {
-                'access': 'allow',
-                'url': item['url']
-            }
-            surt = item['surt']
-            surt = surt.replace('http://(', '', 1)
-            surt = surt.rstrip(',') # Strip any trailing comma
-            pywb_rules.add("%s - %s" % (surt, json.dumps(rule)))
-        return sorted(pywb_rules, reverse=True)
+
+def generate_acl(targets, include_cdns, fmt="pywb", compact=False):
+    # Collate the distinct lines:
+    lines = set(iter_acl_entries(targets, include_cdns, fmt))
+
+    if compact and fmt == "surts":
+        lines = compact_prefixes(lines, what="SURT prefixes")
+    elif compact and fmt == "pywb":
+        # All these rules allow access, so any covered by a shorter rule make no difference:
+        lines = compact_prefixes(lines, key=pywb_rule_key, what="access rules")
+
+    # pywb acl lists are in reverse order:
+    return sorted(lines, reverse=(fmt == "pywb"))
+
+
+# Default amount of memory to use for the lines held in memory when sorting an access list:
+ACL_SORT_MEMORY = 64 * 1024 * 1024
+
+
+def _spill(lines, reverse, tmp_dir):
+    # Write a sorted run of lines out to a temporary file, ready to be read back:
+    run = tempfile.TemporaryFile('w+', encoding='utf-8', dir=tmp_dir)
+    for line in sorted(lines, reverse=reverse):
+        run.write(line)
+        run.write('\n')
+    run.seek(0)
+    return run
+
+
+def external_sort(lines, reverse=False, max_memory=ACL_SORT_MEMORY, tmp_dir=None):
+    """
+    Yields the distinct lines, sorted, holding roughly no more than max_memory bytes of lines
+    in memory at a time. Sorted runs are spilled to temporary files whenever that fills up,
+    and merged at the end. The lines must not contain newlines.
+    """
+    runs = []
+    try:
+        current = set()
+        size = 0
+        for line in lines:
+            if line in current:
+                continue
+            current.add(line)
+            size += sys.getsizeof(line) + 64 # Plus roughly the overhead of a set entry
+            if size >= max_memory:
+                runs.append(_spill(current, reverse, tmp_dir))
+                current = set()
+                size = 0
+        if not runs:
+            # It all fits in memory:
+            yield from sorted(current, reverse=reverse)
+            return
+        if current:
+            runs.append(_spill(current, reverse, tmp_dir))
+        current = None
+        logger.info("Merging %i sorted runs..." % len(runs))
+        last = None
+        for line in heapq.merge(*[(line.rstrip('\n') for line in run) for run in runs], reverse=reverse):
+            if line != last:
+                yield line
+                last = line
+    finally:
+        for run in runs:
+            run.close()
+
+
+def write_acl(f, targets, include_cdns, fmt="pywb", compact=False, max_memory=ACL_SORT_MEMORY, tmp_dir=None):
+    # Writes out the same lines as generate_acl would return, but using an external sort so
+    # memory use stays bounded however many seeds there are:
+    lines = iter_acl_entries(targets, include_cdns, fmt)
+    if compact and fmt != "urls":
+        # Compaction works on the lines in ascending order, so pywb lists need sorting twice:
+        lines = external_sort(lines, max_memory=max_memory, tmp_dir=tmp_dir)
+        if fmt == "surts":
+            lines = iter_compacted(lines, what="SURT prefixes")
+        else:
+            lines = iter_compacted(lines, key=pywb_rule_key, what="access rules")
+            lines = external_sort(lines, reverse=True, max_memory=max_memory, tmp_dir=tmp_dir)
     else:
-        raise Exception("Unknown access list format '%s'!" % fmt)
+        lines = external_sort(lines, reverse=(fmt == "pywb"), max_memory=max_memory, tmp_dir=tmp_dir)
+    for line in lines:
+        f.write("%s\n" % line)
+
+
+def diff_sorted(old_lines, new_lines, reverse=False):
+    """
+    Yields ('-', line) for each line only in the old lines, and ('+', line) for each line only
+    in the new ones, by merging the two in a single pass. Both must be sorted the same way, as
+    the access lists are (i.e. reversed for pywb), and repeated lines are ignored.
+    """
+    def before(a, b):
+        return a > b if reverse else a < b
+
+    def checked(lines, name):
+        last = None
+        for line in lines:
+            if line == last:
+                continue
+            if last is not None and before(line, last):
+                raise Exception("The %s access list is not sorted! '%s' comes after '%s'." % (name, line, last))
+            yield line
+            last = line
+
+    old_lines = checked(old_lines, "previous")
+    new_lines = checked(new_lines, "new")
+    old = next(old_lines, None)
+    new = next(new_lines, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and before(old, new)):
+            yield '-', old
+            old = next(old_lines, None)
+        elif old is None or before(new, old):
+            yield '+', new
+            new = next(new_lines, None)
+        else:
+            old = next(old_lines, None)
+            new = next(new_lines, None)
+
 
+def read_acl(f):
+    # The lines of an access list file, without the newlines:
+    for line in f:
+        line = line.rstrip('\n')
+        if line:
+            yield line
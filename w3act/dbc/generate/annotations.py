@@ -1,20 +1,21 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
-import datetime
 import pytz
+from w3act.dbc.model import as_datetime, walk_terms
 
 logger = logging.getLogger(__name__)
 
 def convert_to_full_iso(db_datetime):
-    dbdt = datetime.datetime.strptime(db_datetime, '%Y-%m-%d %H:%M:%S')
+    # Timestamps are parsed when loaded, but any unusual ones are left as text:
+    dbdt = as_datetime(db_datetime)
     dbdt = dbdt.replace(tzinfo=pytz.utc)
     return dbdt.isoformat(timespec='milliseconds')
 
 def generate_annotations(targets_by_id, collections_by_id, subjects_by_id):
     # Both Collections and Subjects are stored as trees, but to lookup subjects we need to flatten the tree:
     subjects_by_id_flat = {}
-    for subject in _flatten_tree(subjects_by_id.values()):
+    for subject in walk_terms(subjects_by_id.values()):
         sid = subject['id']
         subjects_by_id_flat[sid] = subject
 
@@ -40,15 +41,15 @@ def generate_annotations(targets_by_id, collections_by_id, subjects_by_id):
 
     return annotations
 
-def _flatten_tree(collection):
-    for item in collection:
-        yield item
-        # And the children:
-        if 'children' in item:
-            for item in _flatten_tree(item['children']):
-                yield item
-
 def _add_annotations(annotations, collection, targets_by_id, subjects_by_id, prefix=""):
+    # Work down through the child collections with a stack, in the same order as recursing would:
+    stack = [(collection, prefix)]
+    while stack:
+        collection, prefix = stack.pop()
+        collection_name = _add_collection_annotations(annotations, collection, targets_by_id, subjects_by_id, prefix)
+        stack.extend(reversed([(child, "%s|" % collection_name) for child in collection['children']]))
+
+def _add_collection_annotations(annotations, collection, targets_by_id, subjects_by_id, prefix):
     # assemble full collection name:
     logger.info(f"Adding annotation to collection: {collection}")
     collection_name = "%s%s" % (prefix, collection['name'])
@@ -79,7 +80,7 @@ def _add_annotations(annotations, collection, targets_by_id, subjects_by_id, pre
             annotations['collections'][scope][url] = ann
 
     # And add date ranges:
-    # n.b. format from DB/CSV: 2020-03-13 13:16:22.445
+    # n.b. these are datetimes, parsed from the DB/CSV format: 2020-03-13 13:16:22.445
     annotations['collectionDateRanges'][collection_name] = {}
     if collection['start_date']:
         annotations['collectionDateRanges'][collection_name]['start'] = convert_to_full_iso(collection['start_date'])
@@ -90,6 +91,4 @@ def _add_annotations(annotations, collection, targets_by_id, subjects_by_id, pre
     else:
         annotations['collectionDateRanges'][collection_name]['end'] = None
 
-    # And process child collections:
-    for child_collection in collection['children']:
-        _add_annotations(annotations, child_collection, targets_by_id, subjects_by_id, prefix="%s|" % collection_name)
+    return collection_name
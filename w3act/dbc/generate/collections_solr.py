@@ -2,6 +2,8 @@
 import json
 import pysolr
 import logging
+from w3act.dbc.model import db_text
+from w3act.dbc.index import TaxonomyClosure
 
 logger = logging.getLogger(__name__)
 
@@ -54,8 +56,8 @@ def add_collection(s, targets_by_id, col, parent_id):
                 "url": target["urls"][0],
                 "additionalUrl": target["urls"][1:],
                 "language": target["language"],
-                "startDate": target["crawl_start_date"],
-                "endDate": target["crawl_end_date"],
+                "startDate": db_text(target["crawl_start_date"]),
+                "endDate": db_text(target["crawl_end_date"]),
                 "licenses": licenses
             })
             # When we have a batch, send:
@@ -72,10 +74,6 @@ def add_collection(s, targets_by_id, col, parent_id):
         
         # Log targets
         logger.info("Added %i targets of %i in the collection." % (targets_sent, len(targets_by_id)))
-
-        # Add child collections
-        for cc in col["children"]:
-            add_collection(s, targets_by_id, cc, col['id'])
     else:
         logger.warn("Skipping unpublished collection '%s'." % col['name'])
 
@@ -97,9 +95,13 @@ def populate_collections_solr(solr_endpoint, targets, collections, subjects):
     # First, we delete everything (!)
     s.delete(q="*:*", commit=False)
 
-    # Update the collections:
-    for col in collections.values():
-        add_collection(s, targets_by_id, col, None)
+    # Update the collections, in depth-first order, skipping everything below unpublished ones:
+    closure = TaxonomyClosure(collections.values())
+    i = 0
+    while i < len(closure.order):
+        col = closure.terms[closure.order[i]]
+        add_collection(s, targets_by_id, col, closure.parent[col['id']])
+        i = i + 1 if col['publish'] else closure.end[col['id']]
 
     # Now commit all changes:
     s.commit()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Streaming JSON and JSONL encoders for the W3ACT data model.
+#
+# These encode one entity at a time, producing exactly the same output as json.dump()-ing the
+# whole model, but without holding the whole of the output in memory or modifying the model.
+
+import re
+import json
+import logging
+from w3act.dbc.model import to_json
+
+# Use orjson for the indented JSON if it is installed, as it is much faster than the standard
+# library encoder, which can only use its C implementation when not indenting:
+try:
+    import orjson
+    ORJSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Characters that json.dumps escapes (with the default ensure_ascii=True), but orjson does not:
+RE_NON_ASCII = re.compile('[^\x00-\x7e]')
+
+
+def _escape(match):
+    c = ord(match.group())
+    if c > 0xffff:
+        # Outside the BMP, so escape as a surrogate pair:
+        c -= 0x10000
+        return '\\u%04x\\u%04x' % (0xd800 | (c >> 10), 0xdc00 | (c & 0x3ff))
+    return '\\u%04x' % c
+
+
+def dumps_indented(obj, level=0):
+    # Encode with indent=2, as if nested the given number of levels deep:
+    text = None
+    if orjson is not None:
+        try:
+            text = RE_NON_ASCII.sub(_escape, orjson.dumps(obj, default=to_json, option=ORJSON_OPTIONS).decode('utf-8'))
+        except orjson.JSONEncodeError as e:
+            # e.g. lone surrogates or very large integers, which the standard library can cope with:
+            logger.debug("Falling back to the standard JSON encoder: %s" % e)
+    if text is None:
+        text = json.dumps(obj, indent=2, default=to_json)
+    if level:
+        # Newlines within strings are always escaped, so these are all indentation:
+        text = text.replace('\n', '\n' + '  ' * level)
+    return text
+
+
+def encode_key(key):
+    # Encode a dict key the way the json module does:
+    if isinstance(key, bool):
+        key = 'true' if key else 'false'
+    elif key is None:
+        key = 'null'
+    elif not isinstance(key, str):
+        key = str(key)
+    return json.dumps(key)
+
+
+def _iter_members(members, open, close, level, keyed):
+    indent = '\n' + '  ' * level
+    first = True
+    for key, value in members:
+        if keyed:
+            yield (open if first else ',') + indent + encode_key(key) + ': ' + dumps_indented(value, level)
+        else:
+            yield (open if first else ',') + indent + dumps_indented(value, level)
+        first = False
+    if first:
+        yield open + close
+    else:
+        yield '\n' + '  ' * (level - 1) + close
+
+
+def iter_json(all):
+    # Chunks of the same text as json.dump(all, f, indent=2, default=to_json), one entity per chunk:
+    first = True
+    for w3act_type, items in all.items():
+        yield ('{' if first else ',') + '\n  ' + encode_key(w3act_type) + ': '
+        first = False
+        if isinstance(items, dict):
+            yield from _iter_members(items.items(), '{', '}', 2, keyed=True)
+        elif isinstance(items, list):
+            yield from _iter_members(enumerate(items), '[', ']', 2, keyed=False)
+        else:
+            yield dumps_indented(items, 1)
+    yield '{}' if first else '\n}'
+
+
+def iter_jsonl(all, include_w3act_type=True):
+    # Lines of JSON, one per entity, optionally tagged with the type of entity as 'w3act_type':
+    for w3act_type, items in all.items():
+        if w3act_type != "invalid_targets":
+            items = items.values()
+        # Tagged by splicing the extra key in at the end, as adding it to the item would:
+        tag = '"w3act_type": ' + json.dumps(w3act_type) + '}'
+        for item in items:
+            if include_w3act_type and 'w3act_type' in item:
+                item = dict(item)
+                item['w3act_type'] = w3act_type
+                text = json.dumps(item, default=to_json)
+            else:
+                text = json.dumps(item, default=to_json)
+                if include_w3act_type:
+                    text = text[:-1] + (', ' if text != '{}' else '') + tag
+            yield text + '\n'
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# Export the loaded W3ACT data model as typed, columnar Parquet files, for analytics.
+#
+# This needs the 'pyarrow' package, which is only imported when used.
+
+import os
+import logging
+from w3act.dbc.schema import SCHEMA, TARGET_FLAGS
+from w3act.dbc.model import INT_FIELDS, DATE_FIELDS, ENUM_FIELDS, DERIVED_FIELDS, as_datetime, db_int, walk_terms
+from w3act.dbc.generate.acls import generate_surt
+
+logger = logging.getLogger(__name__)
+
+# Target fields that are not plain strings, besides the flags, INT_FIELDS, DATE_FIELDS and ENUM_FIELDS:
+TARGET_BOOLEAN_FIELDS = TARGET_FLAGS + ["isNPLD", "isOA", "inheritsNPLD", "inheritsOA", "watched"]
+TARGET_ID_FIELDS = ["id", "inheritsNPLDFrom", "inheritsOAFrom", "qaissue_score"]
+TARGET_ID_LIST_FIELDS = ["collection_ids", "subject_ids", "license_ids"]
+TARGET_STRING_LIST_FIELDS = ["urls", "licenses"]
+
+
+def _date(value):
+    # Timestamps are parsed when loaded, but any unusual ones are left as text:
+    if not value:
+        return None
+    try:
+        return as_datetime(value)
+    except (ValueError, OverflowError):
+        logger.warning("Could not parse timestamp '%s', leaving it out." % value)
+        return None
+
+
+def target_field_type(pa, field):
+    if field in TARGET_BOOLEAN_FIELDS:
+        return pa.bool_()
+    elif field in TARGET_ID_FIELDS or field in INT_FIELDS:
+        return pa.int64()
+    elif field in DATE_FIELDS:
+        return pa.timestamp('us')
+    elif field in TARGET_ID_LIST_FIELDS:
+        return pa.list_(pa.int64())
+    elif field in TARGET_STRING_LIST_FIELDS:
+        return pa.list_(pa.string())
+    elif field in ENUM_FIELDS:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def target_field_value(field, value):
+    if field in TARGET_BOOLEAN_FIELDS:
+        return bool(value)
+    elif field in TARGET_ID_FIELDS or field in INT_FIELDS:
+        return db_int(value)
+    elif field in DATE_FIELDS:
+        return _date(value)
+    elif field in TARGET_ID_LIST_FIELDS or field in TARGET_STRING_LIST_FIELDS:
+        return list(value or [])
+    return value
+
+
+def _write(pa, pq, output_dir, name, columns, schema):
+    table = pa.Table.from_pydict(columns, schema=pa.schema(schema))
+    file_path = os.path.join(output_dir, "%s.parquet" % name)
+    pq.write_table(table, file_path)
+    logger.info("Written %i rows to %s" % (table.num_rows, file_path))
+
+
+def generate_parquet(all, output_dir):
+    """
+    Writes the targets (including invalid ones, which have an invalid_reason), their URLs,
+    collections, subjects, licenses and curators as Parquet files in the output folder.
+
+    Targets keep their collection, subject and license IDs and URLs as list columns, and the
+    same relationships are also written out as exploded link tables, so they can be joined.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("The 'pyarrow' package is required for the Parquet export!")
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    targets = list(all['targets'].values()) + list(all['invalid_targets'])
+    fields = list(dict.fromkeys(SCHEMA['target'] + DERIVED_FIELDS))
+    columns = {field: [target_field_value(field, t.get(field, None)) for t in targets] for field in fields}
+    _write(pa, pq, output_dir, 'targets', columns, [(field, target_field_type(pa, field)) for field in fields])
+
+    # Exploded link tables:
+    _write(pa, pq, output_dir, 'urls', {
+        'target_id': [t['id'] for t in targets for url in t.get('urls', [])],
+        'position': [position for t in targets for position in range(len(t.get('urls', [])))],
+        'url': [url for t in targets for url in t.get('urls', [])],
+        'surt': [generate_surt(url) for t in targets for url in t.get('urls', [])],
+    }, [('target_id', pa.int64()), ('position', pa.int32()), ('url', pa.string()), ('surt', pa.string())])
+    for name, key in [('collection_target', 'collection_ids'), ('subject_target', 'subject_ids'), ('license_target', 'license_ids')]:
+        id_name = name.split('_')[0] + '_id'
+        _write(pa, pq, output_dir, name, {
+            id_name: [id for t in targets for id in t.get(key, [])],
+            'target_id': [t['id'] for t in targets for id in t.get(key, [])],
+        }, [(id_name, pa.int64()), ('target_id', pa.int64())])
+
+    # Taxonomies, flattened:
+    for name in ['collections', 'subjects', 'licenses']:
+        terms = list(walk_terms(all[name].values()))
+        _write(pa, pq, output_dir, name, {
+            'id': [term['id'] for term in terms],
+            'parent_id': [db_int(term.get('parent_id', None)) for term in terms],
+            'name': [term['name'] for term in terms],
+            'description': [term.get('description', None) for term in terms],
+            'publish': [bool(term.get('publish', False)) for term in terms],
+            'start_date': [_date(term.get('start_date', None)) for term in terms],
+            'end_date': [_date(term.get('end_date', None)) for term in terms],
+        }, [('id', pa.int64()), ('parent_id', pa.int64()), ('name', pa.string()), ('description', pa.string()),
+            ('publish', pa.bool_()), ('start_date', pa.timestamp('us')), ('end_date', pa.timestamp('us'))])
+
+    curators = list(all['curators'].values())
+    _write(pa, pq, output_dir, 'curators', {
+        'id': [c['id'] for c in curators],
+        'name': [c.get('name', None) for c in curators],
+        'email': [c.get('email', None) for c in curators],
+    }, [('id', pa.int64()), ('name', pa.string()), ('email', pa.string())])
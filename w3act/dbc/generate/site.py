@@ -12,6 +12,8 @@ import unicodedata
 from jinja2 import Environment, PackageLoader
 from urllib.parse import urlparse
 from base64 import urlsafe_b64encode
+from w3act.dbc.model import as_datetime
+from w3act.dbc.index import TaxonomyClosure
 
 
 # Set logging for this module and keep the reference handy:
@@ -61,12 +63,11 @@ class GenerateSitePages():
         self.source = source
         self.output_dir = output_dir
 
-    def get_collections_by_id(self, collections, collections_by_id):
-        for col in collections:
-            collections_by_id[int(col['id'])] = col
+    def get_collections_by_id(self, closure, collections_by_id):
+        for cid, col in closure.terms.items():
+            collections_by_id[int(cid)] = col
             if col['publish']:
                 self.collection_published_count += 1
-            self.get_collections_by_id(col.get('children', []), collections_by_id)
 
     def filter_down(self, targets, collections):
         '''
@@ -102,8 +103,9 @@ class GenerateSitePages():
         #FIXME targets, collections = self.filter_down(targets,collections)
 
         # Index collections by ID:
+        closure = TaxonomyClosure(collections)
         collections_by_id = {}
-        self.get_collections_by_id(collections, collections_by_id)
+        self.get_collections_by_id(closure, collections_by_id)
 
         # Index targets by ID:
         targets_by_id = {}
@@ -119,17 +121,21 @@ class GenerateSitePages():
 
         # Collections
         # FIXME this should output targets using 'page-source-path' rather than ID:
-        self.generate_collections("%s/content/collection" % self.output_dir, env, collections, targets_by_id)
+        self.generate_collections("%s/content/collection" % self.output_dir, env, closure, targets_by_id)
 
-    def generate_collections(self, base_path, env, collections, targets_by_id):
+    def generate_collections(self, base_path, env, closure, targets_by_id):
         template = env.get_template('site-target-template.md')
-        # Emit this level:
-        for col in collections:
-            # Skip unpublished collections:
+        # Emit every collection, in depth-first order:
+        i = 0
+        while i < len(closure.order):
+            col = closure.terms[closure.order[i]]
+            # Skip unpublished collections, and everything below them:
             if col['publish'] != True:
                 logger.warning("The Collection '%s' not to be published! (publish = %s)" % (col['name'], col['publish']) )
                 # FIXME SHOULD DELETE THE FILE IF IT EXISTS!
+                i = closure.end[col['id']]
                 continue
+            i += 1
             # And write:
             rec = {
                 'id': col['id'],
@@ -142,11 +148,8 @@ class GenerateSitePages():
             # Use the ID as the URL:
             rec['url'] = f"ukwa/collection/{col['id']}"
 
-            # Store under a slugified file path:
-            file_path = "%s/%s" % (base_path, slugify(col['name']))
-            # Recurse to generate child collections:
-            if 'children' in col:
-                self.generate_collections(file_path, env, col['children'], targets_by_id)
+            # Store under a slugified file path, below those of the parent collections:
+            file_path = "/".join([base_path] + [slugify(term['name']) for term in closure.path(col['id'])])
 
             # Collect the Targets
             target_ids = []
@@ -185,12 +188,12 @@ class GenerateSitePages():
     def get_target_start_date_force(self, target):
         start_date = target.get('crawl_start_date')
         if not start_date:
-            start_date = "2006-01-01 12:00:00"
-        return start_date
+            start_date = datetime.datetime(2006, 1, 1, 12, 0, 0)
+        return as_datetime(start_date)
 
     def get_target_file_path(self, target):
         start_date = self.get_target_start_date_force(target)
-        return "%s/%s-%s" % (start_date[:4], start_date[:10], slugify(target['title'][:32]))
+        return "%s/%s-%s" % (start_date.strftime('%Y'), start_date.strftime('%Y-%m-%d'), slugify(target['title'][:32]))
 
     def generate_targets(self, env, targets, collections_by_id):
         # Setup specific template:
@@ -248,12 +251,11 @@ class GenerateSitePages():
             #    logger.warning("The URL '%s' is not yet available, inScopeForLegalDeposit = %s" % (url, target['inScopeForLegalDeposit']))
             #    self.missing_record_count += 1
             #    continue
-            start_date_str = target['crawl_start_date']
-            if not start_date_str:
+            if not target['crawl_start_date']:
                 # FIXME This is a Big Problem
                 logger.warning(f"No start date on Target {tid}!")
                 continue
-            start_date =  datetime.datetime.strptime(start_date_str, '%Y-%m-%d %H:%M:%S')
+            start_date = as_datetime(target['crawl_start_date'])
             start_date_iso = start_date.isoformat()
             wayback_date_str = start_date.strftime('%Y%m%d%H%M%S')
             url_b64 = base64.b64encode(hashlib.md5(url.encode('utf-8')).digest())
@@ -262,7 +264,7 @@ class GenerateSitePages():
             # And format the end date
             end_date_iso = None
             if target.get('crawl_end_date', None):
-                end_date_iso = datetime.datetime.strptime(target['crawl_end_date'], '%Y-%m-%d %H:%M:%S').isoformat()
+                end_date_iso = as_datetime(target['crawl_end_date']).isoformat()
 
             # Honour embargo
             #ago = datetime.datetime.now() - wayback_date
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# Export the loaded W3ACT data model as a normalised SQLite database, for fast local querying.
+
+import os
+import sqlite3
+import logging
+from w3act.dbc.schema import SCHEMA
+from w3act.dbc.model import DERIVED_FIELDS, DERIVED_LIST_FIELDS, db_text, db_int, walk_terms
+from w3act.dbc.generate.acls import generate_surt
+
+logger = logging.getLogger(__name__)
+
+# Scalar fields added to targets by load_rows, stored alongside the target columns
+# (the lists go in the link tables):
+TARGET_DERIVED_COLUMNS = [field for field in DERIVED_FIELDS if field not in DERIVED_LIST_FIELDS]
+
+TARGET_COLUMNS = SCHEMA['target'] + TARGET_DERIVED_COLUMNS
+
+TABLES = [
+    "CREATE TABLE targets (%s)" % ", ".join(
+        ['"id" INTEGER PRIMARY KEY'] + ['"%s"' % column for column in TARGET_COLUMNS if column != 'id']),
+    "CREATE TABLE urls (target_id INTEGER, position INTEGER, url TEXT, surt TEXT)",
+    "CREATE TABLE collections (id INTEGER PRIMARY KEY, parent_id INTEGER, name TEXT, description TEXT, "
+    "publish BOOLEAN, start_date TEXT, end_date TEXT)",
+    "CREATE TABLE collection_target (collection_id INTEGER, target_id INTEGER)",
+    "CREATE TABLE collection_areas (id INTEGER PRIMARY KEY, name TEXT, description TEXT)",
+    "CREATE TABLE collection_area_collection (collection_area_id INTEGER, collection_id INTEGER)",
+    "CREATE TABLE subjects (id INTEGER PRIMARY KEY, parent_id INTEGER, name TEXT, description TEXT)",
+    "CREATE TABLE subject_target (subject_id INTEGER, target_id INTEGER)",
+    "CREATE TABLE licenses (id INTEGER PRIMARY KEY, name TEXT, description TEXT)",
+    "CREATE TABLE license_target (license_id INTEGER, target_id INTEGER)",
+    "CREATE TABLE curators (id INTEGER PRIMARY KEY, name TEXT, email TEXT)",
+    "CREATE TABLE organisations (id INTEGER PRIMARY KEY, title TEXT, abbreviation TEXT)",
+]
+
+INDEXES = [
+    "CREATE INDEX targets_crawl_frequency ON targets (crawl_frequency)",
+    "CREATE INDEX urls_target_id ON urls (target_id)",
+    "CREATE INDEX urls_surt ON urls (surt)",
+    "CREATE INDEX collections_parent_id ON collections (parent_id)",
+    "CREATE INDEX collection_target_collection_id ON collection_target (collection_id)",
+    "CREATE INDEX collection_target_target_id ON collection_target (target_id)",
+    "CREATE INDEX collection_area_collection_collection_id ON collection_area_collection (collection_id)",
+    "CREATE INDEX subjects_parent_id ON subjects (parent_id)",
+    "CREATE INDEX subject_target_subject_id ON subject_target (subject_id)",
+    "CREATE INDEX subject_target_target_id ON subject_target (target_id)",
+    "CREATE INDEX license_target_license_id ON license_target (license_id)",
+    "CREATE INDEX license_target_target_id ON license_target (target_id)",
+]
+
+# Full-text search over the target titles and descriptions, using the targets table for the content:
+FTS = [
+    "CREATE VIRTUAL TABLE targets_fts USING fts5(title, description, content='targets', content_rowid='id')",
+    "INSERT INTO targets_fts(targets_fts) VALUES ('rebuild')",
+]
+
+
+def target_rows(targets):
+    for t in targets:
+        yield tuple(db_text(t.get(column, None)) for column in TARGET_COLUMNS)
+
+
+def url_rows(targets):
+    for t in targets:
+        for position, url in enumerate(t.get('urls', [])):
+            yield (t['id'], position, url, generate_surt(url))
+
+
+def generate_sqlite(all, filename):
+    """
+    Writes the data model to a new SQLite database, in a single transaction.
+
+    Targets (including invalid ones, which have an invalid_reason), collections, subjects and
+    the other entities each get a table, with link tables for the many-to-many relationships.
+    """
+    targets = list(all['targets'].values()) + list(all['invalid_targets'])
+    collections = list(walk_terms(all['collections'].values()))
+    subjects = list(walk_terms(all['subjects'].values()))
+
+    # Write to a temporary file, so the database is replaced all at once:
+    tmp_filename = filename + '.tmp'
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    conn = sqlite3.connect(tmp_filename)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        with conn:
+            for sql in TABLES:
+                conn.execute(sql)
+            logger.info("Writing %i targets..." % len(targets))
+            conn.executemany("INSERT INTO targets VALUES (%s)" % ", ".join("?" * len(TARGET_COLUMNS)),
+                             target_rows(targets))
+            conn.executemany("INSERT INTO urls VALUES (?, ?, ?, ?)", url_rows(targets))
+            logger.info("Writing %i collections..." % len(collections))
+            conn.executemany("INSERT INTO collections VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                (c['id'], db_int(c.get('parent_id')), c['name'], c.get('description'), c.get('publish'),
+                 db_text(c.get('start_date')), db_text(c.get('end_date'))) for c in collections))
+            conn.executemany("INSERT INTO collection_target VALUES (?, ?)", (
+                (c['id'], tid) for c in collections for tid in c.get('target_ids', [])))
+            conn.executemany("INSERT INTO collection_areas VALUES (?, ?, ?)", (
+                (a['id'], a['name'], a['description']) for a in all['collection_areas'].values()))
+            conn.executemany("INSERT INTO collection_area_collection VALUES (?, ?)", (
+                (a['id'], cid) for a in all['collection_areas'].values() for cid in a['collections']))
+            logger.info("Writing %i subjects..." % len(subjects))
+            conn.executemany("INSERT INTO subjects VALUES (?, ?, ?, ?)", (
+                (s['id'], db_int(s.get('parent_id')), s['name'], s.get('description')) for s in subjects))
+            conn.executemany("INSERT INTO subject_target VALUES (?, ?)", (
+                (sid, t['id']) for t in targets for sid in t.get('subject_ids', [])))
+            conn.executemany("INSERT INTO licenses VALUES (?, ?, ?)", (
+                (l['id'], l['name'], l.get('description')) for l in walk_terms(all['licenses'].values())))
+            conn.executemany("INSERT INTO license_target VALUES (?, ?)", (
+                (lid, t['id']) for t in targets for lid in t.get('license_ids', [])))
+            conn.executemany("INSERT INTO curators VALUES (?, ?, ?)", (
+                (c['id'], c.get('name'), c.get('email')) for c in all['curators'].values()))
+            conn.executemany("INSERT INTO organisations VALUES (?, ?, ?)", (
+                (o['id'], o.get('title'), o.get('abbreviation')) for o in all['organisations'].values()))
+            logger.info("Indexing...")
+            for sql in INDEXES:
+                conn.execute(sql)
+            try:
+                for sql in FTS:
+                    conn.execute(sql)
+            except sqlite3.OperationalError as e:
+                logger.warning("Could not create the full-text index, as FTS5 is not available: %s" % e)
+    finally:
+        conn.close()
+    os.replace(tmp_filename, filename)
+    logger.info("Written %s" % filename)
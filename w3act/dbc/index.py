@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+#
+# Secondary indexes over the loaded targets, so they can be filtered without scanning them all.
+
+import datetime
+import calendar
+import logging
+import bisect
+from dateutil.relativedelta import relativedelta
+from w3act.dbc.model import as_datetime
+
+logger = logging.getLogger(__name__)
+
+
+class TargetIndex(object):
+    """
+    Sets of target IDs by crawl frequency, crawl terms, hidden and top-level-domain status, plus
+    the targets sorted by crawl end date, built once from the loaded targets.
+
+    filter() gives exactly the same results as scanning the targets with filtered_targets(),
+    in the same order, but only does work in proportion to the sets involved.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        # Position of each target, so results come out in the original order:
+        self.position = {}
+        self.by_frequency = {}
+        self.npld = set()
+        self.oa = set()
+        self.hidden = set()
+        self.top_level_domain = set()
+        for tid, t in targets.items():
+            self.position[tid] = len(self.position)
+            self.by_frequency.setdefault(t['crawl_frequency'].lower(), set()).add(tid)
+            if t.get('isNPLD', None):
+                self.npld.add(tid)
+            if t.get('isOA', None):
+                self.oa.add(tid)
+            if t['hidden']:
+                self.hidden.add(tid)
+            if t['is_top_level_domain']:
+                self.top_level_domain.add(tid)
+        # Only parsed if filtering on expiry is needed:
+        self._end_dates = None
+        self._end_date_tids = None
+
+    def _index_end_dates(self):
+        # n.b. end dates have already been parsed when the targets were loaded:
+        ends = sorted((as_datetime(t['crawl_end_date']), self.position[tid], tid)
+                      for tid, t in self.targets.items() if t['crawl_end_date'])
+        self._end_dates = [end for end, _, _ in ends]
+        self._end_date_tids = [tid for _, _, tid in ends]
+
+    def expired(self, now):
+        # The targets with a crawl end date before the given time:
+        if self._end_dates is None:
+            self._index_end_dates()
+        return set(self._end_date_tids[:bisect.bisect_left(self._end_dates, now)])
+
+    def filter(self, frequency=None, terms='npld', include_hidden=True, omit_uk_tlds=False, include_expired=True):
+        # Filter down by crawl terms:
+        if terms == 'npld':
+            tids = set(self.npld)
+        elif terms == 'oa':
+            tids = set(self.oa)
+        elif terms == 'bypm':
+            # i.e. those with an OA license that are not NPLD:
+            tids = self.oa - self.npld
+        elif terms == 'all' or terms == None:
+            tids = set(self.position)
+        else:
+            logging.error("Unrecognised terms filter '%s'! Only None, 'npld', 'oa' and 'all' are implemented!" % terms)
+            return []
+        # Filter out based on frequencies:
+        if frequency:
+            # If 'all', filter out NEVERCRAWL (whereas 'None' doesn't filter at all).
+            if frequency == 'all':
+                tids -= self.by_frequency.get('nevercrawl', set())
+            # Otherwise, only emit matching frequency:
+            else:
+                tids &= self.by_frequency.get(frequency.lower(), set())
+        # Only emit un-hidden Targets:
+        if not include_hidden:
+            tids -= self.hidden
+        # Don't bother outputting items that are trivially in scope:
+        if omit_uk_tlds:
+            tids -= self.top_level_domain
+        # Don't bother outputting expired items:
+        if not include_expired:
+            now = datetime.datetime.now()
+            for tid in sorted(self.expired(now) & tids, key=self.position.get):
+                t = self.targets[tid]
+                date_delta = as_datetime(t['crawl_end_date']) - now
+                logger.info("Skipping target %i '%s' with crawl end date in the past (%s)" %(t['id'], t['title'], date_delta))
+                tids.discard(tid)
+        # And return, in the original order:
+        return [self.targets[tid] for tid in sorted(tids, key=self.position.get)]
+
+
+# Crawl frequencies that repeat after a fixed time:
+FIXED_PERIODS = {
+    'daily': datetime.timedelta(days=1),
+    'weekly': datetime.timedelta(days=7),
+}
+
+# Crawl frequencies that repeat after a number of calendar months:
+MONTH_PERIODS = {
+    'monthly': 1,
+    'quarterly': 3,
+    'sixmonthly': 6,
+    'annual': 12,
+}
+
+# Fixed periods are phased relative to a Monday, so weekly crawls fall on the same weekday:
+PHASE_EPOCH = datetime.datetime(2001, 1, 1)
+
+
+def next_launch(start, frequency, after):
+    # The first time at or after the given one when a crawl starting at 'start' is due:
+    frequency = frequency.lower()
+    if after <= start:
+        return start
+    if frequency in FIXED_PERIODS:
+        period = FIXED_PERIODS[frequency]
+        return start + -((start - after) // period) * period
+    months = MONTH_PERIODS[frequency]
+    # Start from the last whole period before, working from the start each time as
+    # relativedelta keeps the day-of-month where it can (e.g. 31st Jan, 28th Feb, 31st Mar):
+    k = ((after.year - start.year) * 12 + after.month - start.month) // months * months
+    launch = start + relativedelta(months=k)
+    while launch < after:
+        k += months
+        launch = start + relativedelta(months=k)
+    return launch
+
+
+class ScheduleIndex(object):
+    """
+    Index of when targets are due to be crawled, based on their crawl start and end dates and
+    crawl frequency, so the targets due in a given time range can be found without working out
+    the schedule of every target.
+
+    Targets are bucketed by the phase of their schedule within its period, i.e. the time within
+    the day or week for daily and weekly crawls, or the month within the period plus day of the
+    month for the others. Short ranges only need to look at the buckets they overlap, and the
+    candidates are then checked exactly against their start and end dates.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.position = {}
+        # All the scheduled targets, by frequency:
+        self.by_frequency = {}
+        # Fixed periods: sorted (phase in seconds, tid) for each frequency:
+        self.phases = {}
+        # Month periods: tids by frequency and (month within the period, day of the month):
+        self.month_days = {}
+        for tid, t in targets.items():
+            self.position[tid] = len(self.position)
+            frequency = t['crawl_frequency'].lower()
+            if not t['crawl_start_date']:
+                continue
+            if frequency in FIXED_PERIODS:
+                start = as_datetime(t['crawl_start_date'])
+                phase = (start - PHASE_EPOCH) % FIXED_PERIODS[frequency]
+                self.phases.setdefault(frequency, []).append((phase.total_seconds(), tid))
+            elif frequency in MONTH_PERIODS:
+                start = as_datetime(t['crawl_start_date'])
+                key = (self._month_phase(start, MONTH_PERIODS[frequency]), start.day)
+                self.month_days.setdefault(frequency, {}).setdefault(key, []).append(tid)
+            else:
+                continue
+            self.by_frequency.setdefault(frequency, []).append(tid)
+        for phases in self.phases.values():
+            phases.sort()
+
+    @staticmethod
+    def _month_phase(date, months):
+        return (date.year * 12 + date.month - 1) % months
+
+    def _fixed_candidates(self, frequency, start, end):
+        period = FIXED_PERIODS[frequency]
+        if end - start >= period:
+            return self.by_frequency.get(frequency, [])
+        phases = self.phases.get(frequency, [])
+        lo = ((start - PHASE_EPOCH) % period).total_seconds()
+        hi = ((end - PHASE_EPOCH) % period).total_seconds()
+        first = bisect.bisect_left(phases, (lo,))
+        last = bisect.bisect_right(phases, (hi, float('inf')))
+        if lo <= hi:
+            return [tid for _, tid in phases[first:last]]
+        # The range wraps around the end of the period:
+        return [tid for _, tid in phases[first:]] + [tid for _, tid in phases[:last]]
+
+    def _month_candidates(self, frequency, start, end):
+        months = MONTH_PERIODS[frequency]
+        if end - start >= datetime.timedelta(days=31 * months):
+            return self.by_frequency.get(frequency, [])
+        buckets = self.month_days.get(frequency, {})
+        candidates = []
+        day = start.date()
+        while day <= end.date():
+            phase = self._month_phase(day, months)
+            candidates.extend(buckets.get((phase, day.day), []))
+            # Crawls on days the month does not have happen on its last day:
+            if day.day == calendar.monthrange(day.year, day.month)[1]:
+                for missing in range(day.day + 1, 32):
+                    candidates.extend(buckets.get((phase, missing), []))
+            day += datetime.timedelta(days=1)
+        return candidates
+
+    def due(self, start, end):
+        # The targets with a crawl due at or after the start time and before the end time:
+        tids = set()
+        for frequency in self.by_frequency:
+            if frequency in FIXED_PERIODS:
+                candidates = self._fixed_candidates(frequency, start, end)
+            else:
+                candidates = self._month_candidates(frequency, start, end)
+            for tid in candidates:
+                t = self.targets[tid]
+                launch = next_launch(as_datetime(t['crawl_start_date']), frequency, start)
+                if launch >= end:
+                    continue
+                if t['crawl_end_date'] and launch > as_datetime(t['crawl_end_date']):
+                    continue
+                tids.add(tid)
+        # And return, in the original order:
+        return [self.targets[tid] for tid in sorted(tids, key=self.position.get)]
+
+
+class TaxonomyClosure(object):
+    """
+    Closure of a taxonomy tree, i.e. the collections or subjects as extracted when loading, so
+    questions about the tree can be answered by lookups rather than by walking it each time.
+
+    Terms are numbered in the order of a depth-first walk, so the descendants of each term are
+    the run of terms up to the end of its subtree, and ancestry is a comparison of positions.
+    The parent and depth of every term, and the targets in the subtree below it (i.e. in the
+    term itself or any of its sub-terms), are worked out once, without recursion.
+
+    It is built from the loaded trees when needed, e.g. TaxonomyClosure(all['collections'].values()),
+    so it always reflects any filtering of the trees, such as dropping unpublished collections.
+    """
+
+    def __init__(self, terms):
+        # All the terms, by ID, in depth-first order:
+        self.terms = {}
+        self.order = []
+        self.position = {}
+        self.end = {}
+        self.parent = {}
+        self.depth = {}
+        self.subtree_target_ids = {}
+        stack = [(term, None) for term in reversed(list(terms))]
+        while stack:
+            term, pid = stack.pop()
+            tid = term['id']
+            if tid in self.terms:
+                logger.warning("Taxonomy term %s appears more than once in the tree!" % tid)
+                continue
+            self.terms[tid] = term
+            self.position[tid] = len(self.order)
+            self.order.append(tid)
+            self.parent[tid] = pid
+            self.depth[tid] = 0 if pid is None else self.depth[pid] + 1
+            stack.extend((child, tid) for child in reversed(term.get('children', [])))
+        # Work back up from the last terms, finding where each subtree ends and what it holds:
+        for tid in reversed(self.order):
+            self.end.setdefault(tid, self.position[tid] + 1)
+            self.subtree_target_ids.setdefault(tid, set()).update(self.terms[tid].get('target_ids', []))
+            pid = self.parent[tid]
+            if pid is not None:
+                self.end.setdefault(pid, self.end[tid])
+                self.subtree_target_ids.setdefault(pid, set()).update(self.subtree_target_ids[tid])
+
+    def ancestors(self, tid):
+        # The IDs of the terms above the given one, from the top of the tree down:
+        ancestors = []
+        pid = self.parent[tid]
+        while pid is not None:
+            ancestors.append(pid)
+            pid = self.parent[pid]
+        return ancestors[::-1]
+
+    def descendants(self, tid):
+        # The IDs of all the terms below the given one, in depth-first order:
+        return self.order[self.position[tid] + 1:self.end[tid]]
+
+    def is_ancestor(self, ancestor_id, tid):
+        return self.position[ancestor_id] < self.position[tid] < self.end[ancestor_id]
+
+    def path(self, tid):
+        # The terms from the top of the tree down to the given one:
+        return [self.terms[aid] for aid in self.ancestors(tid)] + [self.terms[tid]]
+
+    def target_count(self, tid):
+        # The number of distinct targets in the term and all its sub-terms:
+        return len(self.subtree_target_ids[tid])
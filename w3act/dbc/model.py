@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Compact in-memory representations of the W3ACT data model.
+
+import sys
+import datetime
+import dateutil.parser
+from collections.abc import MutableMapping
+from w3act.dbc.schema import SCHEMA
+
+# Integer columns, stored as ints but presented as the strings found in the CSV:
+INT_FIELDS = frozenset(["author_id", "organisation_id", "qaissue_id", "wct_id"])
+
+# Timestamp columns, parsed into datetimes by load_rows (see db_datetime):
+DATE_FIELDS = frozenset(["created_at", "updated_at", "crawl_start_date", "crawl_end_date"])
+
+# Timestamp columns of taxonomy terms (e.g. the date range of collections), also parsed by load_rows:
+TAXONOMY_DATE_FIELDS = frozenset(["start_date", "end_date"])
+
+# Columns with a small set of values, stored as interned strings so each value is only held once:
+ENUM_FIELDS = frozenset(["crawl_frequency", "scope", "depth", "language", "license_status", "live_site_status"])
+
+# Fields added to targets by load_rows:
+DERIVED_FIELDS = [
+    "urls", "collection_ids", "subject_ids", "licenses", "license_ids", "qaissue", "qaissue_score",
+    "isNPLD", "isOA", "inheritsNPLD", "inheritsOA", "inheritsNPLDFrom", "inheritsOAFrom",
+    "watched", "document_url_scheme", "invalid_reason"
+]
+
+# The derived fields that hold lists rather than single values:
+DERIVED_LIST_FIELDS = ["urls", "collection_ids", "subject_ids", "licenses", "license_ids"]
+
+
+def parse_db_datetime(text):
+    # Fast parser for PostgreSQL timestamps, e.g. '2020-03-13 13:16:22.445', returning None for anything else:
+    if len(text) < 19 or text[4] != '-' or text[7] != '-' or text[10] != ' ' or text[13] != ':' or text[16] != ':':
+        return None
+    try:
+        microsecond = 0
+        if len(text) > 19:
+            fraction = text[20:]
+            if text[19] != '.' or not fraction.isdigit() or len(fraction) > 6:
+                return None
+            microsecond = int(fraction.ljust(6, '0'))
+        return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                                 int(text[11:13]), int(text[14:16]), int(text[17:19]), microsecond)
+    except ValueError:
+        return None
+
+
+def format_db_datetime(value):
+    # Format a timestamp the way PostgreSQL does, i.e. dropping trailing zeros from the fraction:
+    text = value.isoformat(sep=' ')
+    if value.microsecond:
+        text = text.rstrip('0')
+    return text
+
+
+def db_datetime(text):
+    # Parse a timestamp from the CSV once, at load time. Empty values stay as '', and anything
+    # that would not be written back out as exactly the same text is left as it is:
+    if text:
+        parsed = parse_db_datetime(text)
+        if parsed is not None and format_db_datetime(parsed) == text:
+            return parsed
+    return text
+
+
+def db_text(value):
+    # The reverse of db_datetime, i.e. timestamps back to the text they were loaded from:
+    if isinstance(value, datetime.datetime):
+        return format_db_datetime(value)
+    return value
+
+
+def as_datetime(value):
+    # For the rare timestamps db_datetime left as text:
+    if isinstance(value, datetime.datetime):
+        return value
+    return dateutil.parser.parse(value)
+
+
+def db_int(value):
+    # IDs are sometimes held as strings, and missing ones as '':
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def walk_terms(terms):
+    # All the terms in the given taxonomy trees, depth-first, without recursion:
+    stack = list(reversed(list(terms)))
+    while stack:
+        term = stack.pop()
+        yield term
+        stack.extend(reversed(term.get('children', [])))
+
+
+# Key orders are shared between targets, so each target only holds a reference to one:
+_key_orders = {}
+
+
+def _shared_keys(keys):
+    return _key_orders.setdefault(keys, keys)
+
+
+class Target(MutableMapping):
+    """
+    A compact W3ACT target, with typed attributes that take up much less memory than a row dict.
+    Timestamps are already datetimes by the time targets are built (see db_datetime).
+
+    It also behaves as a mapping that presents exactly the same keys, order and values as the
+    row dicts built by load_rows, so it can be used anywhere those are.
+    """
+
+    __slots__ = tuple(dict.fromkeys(SCHEMA['target'] + DERIVED_FIELDS)) + ('_keys', '_extra')
+
+    _fields = frozenset(__slots__) - frozenset(['_keys', '_extra'])
+
+    def __init__(self, row):
+        self._keys = ()
+        self._extra = None
+        for key, value in row.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+            if key in INT_FIELDS:
+                return '' if value is None else str(value)
+            return value
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            if isinstance(value, str):
+                if key in INT_FIELDS:
+                    value = int(value) if value else None
+                elif key in ENUM_FIELDS:
+                    value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        if key not in self._keys:
+            self._keys = _shared_keys(self._keys + (key,))
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key in self._fields:
+            delattr(self, key)
+        else:
+            del self._extra[key]
+        self._keys = _shared_keys(tuple(k for k in self._keys if k != key))
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "Target(%r)" % dict(self)
+
+
+def to_json(obj):
+    # For use as the 'default' of JSON encoders, so model objects are written out as plain dicts,
+    # and timestamps as they are in the CSV:
+    if isinstance(obj, Target):
+        return dict(obj)
+    if isinstance(obj, datetime.datetime):
+        return format_db_datetime(obj)
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+# The W3ACT database tables and columns that the w3act tools actually use.
+#
+# This is used to project exports and loads down to just these columns. Columns listed here
+# that are not present in a given database are ignored, and 'updated_at' is kept so that
+# incremental downloads still work.
+
+# Boolean flags on targets, which load_rows turns into proper booleans:
+TARGET_FLAGS = [
+    "active", "hidden", "ignore_robots_txt", "is_in_scope_ip", "is_in_scope_ip_without_license",
+    "is_top_level_domain", "is_uk_hosting", "is_uk_registration", "key_site", "no_ld_criteria_met",
+    "professional_judgement", "special_dispensation", "uk_postal_address", "via_correspondence"
+]
+
+SCHEMA = {
+    'target': [
+        "id", "created_at", "updated_at", "title", "description",
+        "crawl_frequency", "crawl_start_date", "crawl_end_date", "depth", "scope", "language",
+        "login_page_url", "logout_url", "secret_id", "wct_id",
+        "author_id", "organisation_id", "originating_organisation", "qaissue_id",
+        "license_status", "live_site_status",
+        "professional_judgement_exp", "uk_postal_address_url", "value",
+    ] + TARGET_FLAGS,
+    'field_url': ["id", "updated_at", "url", "position", "target_id"],
+    'taxonomy': [
+        "id", "updated_at", "ttype", "name", "description", "parent_id", "publish", "start_date", "end_date"
+    ],
+    'collection_target': ["collection_id", "target_id"],
+    'subject_target': ["subject_id", "target_id"],
+    'license_target': ["license_id", "target_id"],
+    'taxonomy_parents_all': ["taxonomy_id", "parent_id"],
+    'watched_target': ["id", "id_target", "document_url_scheme"],
+    'creator': ["id", "updated_at", "name", "email"],
+    'organisation': ["id", "updated_at", "title", "abbreviation"],
+}
+
+
+def project_columns(table, columns):
+    # The subset of the given columns of a table that are used, in their original order:
+    wanted = SCHEMA.get(table, [])
+    return [column for column in columns if column in wanted]
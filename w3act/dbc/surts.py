@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# A SURT-keyed prefix trie, for finding the Targets whose seeds cover a given URL.
+#
+# URLs are split into tokens: the host labels in SURT order (e.g. 'uk', 'co', 'example'),
+# then a marker for the end of the host, then the path segments. A seed that covers all
+# subdomains of a host ends after the host labels, one that only covers the host itself ends
+# with the marker, and anything more specific ends with its path segments.
+
+from w3act.dbc.generate.acls import generate_surt
+
+# Marks the end of the host part of the tokens, i.e. 'this host and not its subdomains':
+HOST_END = ')'
+
+
+def surt_tokens(url, surt=None):
+    # The tokens of the URL, as a tuple, from its SURT if that is already known:
+    if surt is None:
+        surt = generate_surt(url)
+    if surt.startswith('http://('):
+        surt = surt[len('http://('):]
+    host, _, path = surt.partition(')')
+    tokens = host.rstrip(',').split(',')
+    segments = path.split('/')[1:]
+    if segments == ['']:
+        segments = []
+    return tuple(tokens + [HOST_END] + segments)
+
+
+class SurtTrie(object):
+    """
+    Prefix trie of URLs, keyed on their SURT tokens (see surt_tokens), mapping each URL to the
+    values added for it. Working on the tokens means each URL only has to be converted once.
+
+    Nodes are plain dicts of token to child node, with the values stored under the None key.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, tokens, value, subdomains=False):
+        # Host roots can be added so they cover all subdomains, by stopping after the host labels:
+        if subdomains and tokens[-1] == HOST_END:
+            tokens = tokens[:-1]
+        node = self.root
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node.setdefault(None, []).append(value)
+
+    def covering(self, tokens):
+        # The values of all the entries covering the URL, nearest (i.e. most specific) first:
+        found = []
+        node = self.root
+        for token in tokens:
+            node = node.get(token)
+            if node is None:
+                break
+            if None in node:
+                found.append(node[None])
+        return [value for values in reversed(found) for value in values]
+
+    def nearest(self, tokens, exclude=None):
+        # The value of the nearest entry covering the URL, ignoring the excluded value:
+        for value in self.covering(tokens):
+            if value != exclude:
+                return value
+        return None